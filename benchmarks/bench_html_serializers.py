@@ -0,0 +1,120 @@
+"""
+Compares the HTML serializers used when saving exported pages.
+
+Run on saved export_view bodies (e.g., the bodies of a previous run saved with --save-corpus):
+    poetry run python benchmarks/bench_html_serializers.py corpus_folder/
+or fetch the bodies of a page and its descendants from Confluence (credentials from .env_local):
+    poetry run python benchmarks/bench_html_serializers.py --space NL --title "Some page"
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from html_serializer import SERIALIZERS  # noqa: E402
+
+
+def load_corpus(paths: list[str]) -> dict[str, str]:
+    corpus = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _dirnames, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith(".html"):
+                        full_path = os.path.join(dirpath, filename)
+                        with open(full_path, encoding="utf-8") as f:
+                            corpus[full_path] = f.read()
+        else:
+            with open(path, encoding="utf-8") as f:
+                corpus[path] = f.read()
+    return corpus
+
+
+def fetch_corpus(space: str, title: str) -> dict[str, str]:
+    from dotenv import load_dotenv
+
+    from confluence_client import ConfluenceClient, page_html
+
+    load_dotenv()
+    load_dotenv(dotenv_path=".env_local", override=True)
+    cclient = ConfluenceClient(
+        url=os.environ.get("CONFLUENCE_URL", "https://navasage.atlassian.net")
+    )
+    page_id = cclient.api.get_page_id(space, title)
+    return {
+        f"{page['id']}.html": page_html(page)
+        for page in cclient.iter_descendant_pages(page_id, include_body=True)
+    }
+
+
+def save_corpus(corpus: dict[str, str], folder: str):
+    os.makedirs(folder, exist_ok=True)
+    for name, html_value in corpus.items():
+        with open(os.path.join(folder, os.path.basename(name)), "w", encoding="utf-8") as f:
+            f.write(html_value)
+
+
+def bench(serialize, corpus: dict[str, str], repeat: int) -> dict:
+    output_bytes = 0
+    for html_value in corpus.values():
+        out = io.StringIO()
+        serialize(html_value, out)
+        output_bytes += len(out.getvalue().encode())
+
+    seconds = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for html_value in corpus.values():
+            # Discards the output like a file would, without keeping it in memory
+            serialize(html_value, NullWriter())
+        seconds = min(seconds, time.perf_counter() - started)
+
+    tracemalloc.start()
+    for html_value in corpus.values():
+        serialize(html_value, NullWriter())
+    _current, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "output_bytes": output_bytes, "peak_bytes": peak_bytes}
+
+
+class NullWriter:
+    def write(self, s: str) -> int:
+        return len(s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="HTML files or folders of export_view bodies")
+    parser.add_argument("--space", help="Confluence space key to fetch pages from")
+    parser.add_argument("--title", help="Title of the page whose descendants are fetched")
+    parser.add_argument("--save-corpus", help="Folder to save the fetched bodies to")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.space and args.title:
+        corpus = fetch_corpus(args.space, args.title)
+        if args.save_corpus:
+            save_corpus(corpus, args.save_corpus)
+    elif args.paths:
+        corpus = load_corpus(args.paths)
+    else:
+        parser.error("Provide HTML paths or --space and --title")
+
+    input_bytes = sum(len(html_value.encode()) for html_value in corpus.values())
+    print(f"{len(corpus)} documents, {input_bytes / 1e6:.2f} MB")
+    print(f"{'serializer':<10} {'seconds':>8} {'MB/s':>8} {'output MB':>10} {'peak MB':>8}")
+    for name, serialize in SERIALIZERS.items():
+        result = bench(serialize, corpus, args.repeat)
+        print(
+            f"{name:<10} {result['seconds']:>8.3f} {input_bytes / 1e6 / result['seconds']:>8.2f}"
+            f" {result['output_bytes'] / 1e6:>10.2f} {result['peak_bytes'] / 1e6:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+
+# Optional dependency: `poetry install --extras async`
+import httpx
+
+from confluence_client import (
+    BODY_EXPAND,
+    BodyCache,
+    page_expand,
+    page_folder,
+    page_html,
+    page_link,
+    resolve_credentials,
+    save_page_html,
+)
+
+from rate_limit import get_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConfluenceClient:
+    """
+    Asyncio alternative to ConfluenceClient with the same methods, which uses a single
+    httpx.AsyncClient so that many requests can be in flight over pooled keep-alive connections.
+    Use as an async context manager within the event loop that makes the requests.
+    """
+
+    def __init__(
+        self,
+        *,
+        url: str | None = None,
+        username: str | None = None,
+        api_key: str | None = None,
+        max_connections: int = 100,
+        body_cache: BodyCache | None = None,
+    ):
+        url, username, api_key = resolve_credentials(url, username, api_key)
+        # Same as atlassian.Confluence
+        if ("atlassian.net" in url or "jira.com" in url) and ("/wiki" not in url):
+            url = f"{url.rstrip('/')}/wiki"
+        self.url = url
+        self.http = httpx.AsyncClient(
+            base_url=url,
+            auth=(username, api_key),
+            headers={"Accept": "application/json"},
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+            timeout=75,
+        )
+        self.body_cache = body_cache or BodyCache()
+        self.limiter = get_limiter("Confluence")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http.aclose()
+
+    async def _get(self, path: str, params: dict | None = None) -> dict:
+        return await self.limiter.acall(self._get_once, path, params)
+
+    async def _get_once(self, path: str, params: dict | None) -> dict:
+        response = await self.http.get(path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def _get_all_entities(self, path: str, params: dict) -> list:
+        entities = []
+        start = 0
+        while True:
+            response = await self._get(path, params={**params, "start": start})
+            entities += response["results"]
+            if not response["_links"].get("next"):
+                logger.info("Got %r total entities", len(entities))
+                return entities
+            start += response["limit"]
+
+    async def get_global_spaces(self, limit: int = 30):
+        return await self._get_all_entities(
+            "rest/api/space", {"limit": limit, "type": "global", "expand": "homepage"}
+        )
+
+    async def get_child_pages(self, page_id: str, *, include_body=False):
+        return await self._get_all_entities(
+            f"rest/api/content/{page_id}/child/page",
+            {"limit": 200, "expand": page_expand(include_body)},
+        )
+
+    async def get_descendant_pages(self, page_id: str, limit: int = 250, *, include_body=False):
+        "See ConfluenceClient.iter_descendant_pages()"
+        entities = []
+        response = await self._get(
+            "rest/api/content/search",
+            params={
+                "cql": f"ancestor = {page_id} and type = page",
+                "limit": limit,
+                "expand": f"ancestors,{page_expand(include_body)}",
+            },
+        )
+        while True:
+            entities += response["results"]
+            if not (next_link := response["_links"].get("next")):
+                return entities
+            response = await self._get(f"{response['_links']['base']}{next_link}")
+
+    async def get_page_id(self, space: str, title: str) -> str:
+        response = await self._get(
+            "rest/api/content", params={"spaceKey": space, "title": title, "type": "page"}
+        )
+        if not response["results"]:
+            raise ValueError(f"Page {title!r} not found in space {space!r}")
+        return response["results"][0]["id"]
+
+    async def get_page_by_id(self, page_id: str, expand: str | None = None) -> dict:
+        return await self._get(
+            f"rest/api/content/{page_id}", params={"expand": expand} if expand else None
+        )
+
+    async def list_pages(self, space: str, title: str):
+        page_id = await self.get_page_id(space, title)
+        return await self.get_child_pages(page_id)
+
+    def cache_page_body(self, page: dict):
+        if "body" in page and "version" in page:
+            self.body_cache.put(page["id"], page["version"]["number"], page_html(page))
+
+    async def get_page_html(self, page_id: str, version: int | None = None) -> str:
+        if version is not None:
+            # BodyCache may read from disk
+            html_value = await asyncio.to_thread(self.body_cache.get, page_id, version)
+            if html_value:
+                return html_value
+        page = await self.get_page_by_id(page_id, expand=f"version,{BODY_EXPAND}")
+        await asyncio.to_thread(self.cache_page_body, page)
+        return page_html(page)
+
+    async def export_page_html(self, page_id, folder, create_ancestor_folders=True):
+        page = await self.get_page_by_id(page_id, expand=f"space,ancestors,version,{BODY_EXPAND}")
+        if create_ancestor_folders:
+            folder = page_folder(page, folder)
+        # Parsing and writing the file would otherwise block the event loop
+        return await asyncio.to_thread(
+            save_page_html, page["title"], page_link(page), page_html(page), folder
+        )
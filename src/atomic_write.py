@@ -0,0 +1,40 @@
+import os
+import uuid
+from typing import IO, Callable
+
+
+def replace_file(tmp_path: str, path: str) -> bool:
+    "The default replace() for atomic_write()"
+    os.replace(tmp_path, path)
+    return True
+
+
+def atomic_write(
+    path: str,
+    write: Callable[[IO], None],
+    *,
+    mode: str = "w",
+    opener: Callable[..., IO] = open,
+    replace: Callable[[str, str], bool] = replace_file,
+) -> bool:
+    """
+    Calls write(f) with a temporary file opened with opener() next to path, then renames it to
+    path with replace(tmp_path, path), so that path never holds a partially written file.
+    The temporary file's name is unique, so concurrent writers of the same path do not clash,
+    and hidden, so that it is not uploaded to GDrive if left behind. Text files are UTF-8.
+    replace() returns whether it replaced path; if not, the temporary file is removed.
+    Returns whether path was replaced.
+    """
+    folder, filename = os.path.split(path)
+    tmp_path = os.path.join(folder, f".{filename}.{uuid.uuid4().hex}.tmp")
+    try:
+        with opener(tmp_path, mode, encoding=None if "b" in mode else "utf-8") as f:
+            write(f)
+        replaced = replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if not replaced:
+        os.remove(tmp_path)
+    return replaced
@@ -0,0 +1,229 @@
+import base64
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Callable
+from urllib.parse import urljoin, urlparse
+
+import requests
+
+from atomic_write import atomic_write
+from html_serializer import LINK_ATTRS, RewriteUrl
+
+logger = logging.getLogger(__name__)
+
+# Hidden so that it is not uploaded to GDrive
+ATTACHMENTS_FOLDER = ".attachments"
+INDEX_FILENAME = "index.json"
+
+ATTACHMENT_MAX_MB = float(os.environ.get("ATTACHMENT_MAX_MB", 10))
+ATTACHMENT_BUDGET_MB = float(os.environ.get("ATTACHMENT_BUDGET_MB", 500))
+ATTACHMENT_MAX_WORKERS = int(os.environ.get("ATTACHMENT_MAX_WORKERS", 8))
+# "relative" links to the stored files; "inline" embeds images as data URIs so that
+# importing the HTML into Google Docs keeps them
+ATTACHMENT_LINKS = os.environ.get("ATTACHMENT_LINKS", "relative")
+
+
+class LinkCollector(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links: list[tuple[str, str]] = []
+
+    def handle_starttag(self, tag, attrs):
+        if link_attr := LINK_ATTRS.get(tag):
+            for name, value in attrs:
+                if name == link_attr and value:
+                    self.links.append((tag, value))
+
+    handle_startendtag = handle_starttag
+
+
+def attachment_url(tag: str, url: str, base_url: str) -> str | None:
+    "Returns the absolute URL if it refers to an image or attachment hosted by Confluence"
+    absolute_url = urljoin(f"{base_url.rstrip('/')}/", url)
+    parsed = urlparse(absolute_url)
+    if parsed.netloc != urlparse(base_url).netloc:
+        return None
+    if tag == "img" or "/download/attachments/" in parsed.path:
+        return absolute_url
+    return None
+
+
+def find_attachment_urls(html_value: str, base_url: str) -> list[str]:
+    collector = LinkCollector()
+    collector.feed(html_value)
+    collector.close()
+    urls = (attachment_url(tag, url, base_url) for tag, url in collector.links)
+    return list(dict.fromkeys(url for url in urls if url))
+
+
+class AttachmentStore:
+    """
+    Downloads the images and attachments referenced by exported pages into a content-addressed
+    folder in the export folder, so that a file referenced by many pages is stored once.
+    Downloads run concurrently and each URL is downloaded at most once, even across exports.
+    Files larger than max_file_bytes, and downloads after max_total_bytes have been downloaded,
+    are skipped; their links keep pointing to Confluence.
+    """
+
+    def __init__(
+        self,
+        export_folder: str,
+        base_url: str,
+        open_download: Callable[[str], requests.Response],
+        *,
+        max_file_bytes: int = int(ATTACHMENT_MAX_MB * 1024 * 1024),
+        max_total_bytes: int = int(ATTACHMENT_BUDGET_MB * 1024 * 1024),
+        max_workers: int = ATTACHMENT_MAX_WORKERS,
+        links: str = ATTACHMENT_LINKS,
+    ):
+        if links not in ("relative", "inline"):
+            raise ValueError(f"Unknown attachment links option: {links!r}")
+        self.folder = os.path.join(export_folder, ATTACHMENTS_FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        self.base_url = base_url
+        self.open_download = open_download
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.links = links
+
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(self.folder, INDEX_FILENAME)
+        # Maps each downloaded URL to its filename in the store
+        self.index: dict[str, str] = {}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, encoding="utf-8") as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable attachment index %r: %s", self.index_path, e)
+        self.futures: dict[str, Future] = {}
+        self.downloaded_bytes = 0
+        self.budget_exceeded = False
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="attach")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        with self.lock:
+            data = json.dumps(self.index, indent=1, sort_keys=True)
+        atomic_write(self.index_path, lambda f: f.write(data))
+        logger.info(
+            "Attachments: %i files indexed, %i bytes downloaded",
+            len(self.index),
+            self.downloaded_bytes,
+        )
+
+    def localize(self, html_value: str, page_folder: str) -> RewriteUrl:
+        """
+        Downloads the attachments referenced by html_value (unless already stored) and returns
+        a function that rewrites a tag's link to the stored file for an HTML file in page_folder
+        """
+        urls = find_attachment_urls(html_value, self.base_url)
+        futures = {url: self._fetch(url) for url in urls}
+        stored = {url: filename for url, f in futures.items() if (filename := f.result())}
+
+        def rewrite_url(tag: str, url: str) -> str:
+            absolute_url = attachment_url(tag, url, self.base_url)
+            if not (filename := stored.get(absolute_url)):
+                return url
+            path = os.path.join(self.folder, filename)
+            if self.links == "inline" and tag == "img":
+                return data_uri(path)
+            return os.path.relpath(path, page_folder).replace(os.sep, "/")
+
+        return rewrite_url
+
+    def _fetch(self, url: str) -> Future:
+        with self.lock:
+            if url not in self.futures:
+                filename = self.index.get(url)
+                if filename and os.path.isfile(os.path.join(self.folder, filename)):
+                    self.futures[url] = Future()
+                    self.futures[url].set_result(filename)
+                else:
+                    self.futures[url] = self.executor.submit(self._download, url)
+            return self.futures[url]
+
+    def _reserve(self, num_bytes: int) -> bool:
+        "Counts num_bytes against the budget, returning False if the budget is exceeded"
+        with self.lock:
+            if self.downloaded_bytes + num_bytes > self.max_total_bytes:
+                if not self.budget_exceeded:
+                    logger.warning(
+                        "Attachment download budget of %i bytes exceeded", self.max_total_bytes
+                    )
+                self.budget_exceeded = True
+                return False
+            self.downloaded_bytes += num_bytes
+            return True
+
+    def _download(self, url: str) -> str | None:
+        "Returns the filename of the stored file, or None if it was not downloaded"
+        if self.budget_exceeded:
+            return None
+        tmp_path = os.path.join(self.folder, f".{threading.get_ident()}.tmp")
+        try:
+            filename = self._download_to(url, tmp_path)
+        except (requests.RequestException, OSError) as e:
+            logger.warning("Failed to download %r: %s", url, e)
+            filename = None
+        if filename is None:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        path = os.path.join(self.folder, filename)
+        if os.path.exists(path):
+            # Same content as another URL
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.index[url] = filename
+        return filename
+
+    def _download_to(self, url: str, tmp_path: str) -> str | None:
+        "Streams the download to tmp_path and returns its content-addressed filename"
+        with self.open_download(url) as response:
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > self.max_file_bytes:
+                logger.warning("Skipping %r: %i bytes is too large", url, content_length)
+                return None
+            sha = hashlib.sha256()
+            size = 0
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        logger.warning("Skipping %r: larger than %i bytes", url, size)
+                        return None
+                    if not self._reserve(len(chunk)):
+                        return None
+                    sha.update(chunk)
+                    f.write(chunk)
+            content_type = response.headers.get("Content-Type", "")
+        return f"{sha.hexdigest()}{file_extension(url, content_type)}"
+
+
+def file_extension(url: str, content_type: str) -> str:
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    if 1 < len(extension) <= 5:
+        return extension
+    return mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+
+
+def data_uri(path: str) -> str:
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode()}"
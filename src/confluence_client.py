@@ -1,14 +1,28 @@
+import hashlib
 import logging
 import os
 import re
+import threading
+from collections import OrderedDict
+from typing import Callable
 
+import requests
 from atlassian import Confluence
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from atomic_write import atomic_write, replace_file
+from export_manifest import file_hash
+from html_serializer import RewriteUrl, get_serializer
+from rate_limit import get_limiter
+from response_cache import ResponseCache
 
 logger = logging.getLogger(__name__)
 
 
-def create_client(url: str | None = None, username: str | None = None, api_key: str | None = None):
+def resolve_credentials(
+    url: str | None = None, username: str | None = None, api_key: str | None = None
+) -> tuple[str, str, str]:
+    "Defaults to using environment variables for missing values"
     if url is None:
         url = os.environ.get("CONFLUENCE_URL")
     assert url
@@ -19,69 +33,459 @@ def create_client(url: str | None = None, username: str | None = None, api_key:
         api_key = os.environ.get("ATLASSIAN_API_KEY")
     assert api_key
     logger.info("Confluence %r: %r", url, username)
+    return url, username, api_key
+
+
+class ThreadLocalSession:
+    """
+    Stands in for the requests.Session of an atlassian.Confluence client so that one client can
+    be used by many threads. requests.Session is not thread-safe, so each thread gets its own
+    Session (copied from the template), but all Sessions share one HTTPAdapter and hence
+    one pool of keep-alive connections.
+    """
+
+    def __init__(self, template: requests.Session, adapter: HTTPAdapter):
+        self.template = template
+        self.adapter = adapter
+        self.local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if (session := getattr(self.local, "session", None)) is None:
+            session = requests.Session()
+            session.auth = self.template.auth
+            session.headers.update(self.template.headers)
+            session.cookies.update(self.template.cookies)
+            session.verify = self.template.verify
+            session.cert = self.template.cert
+            session.proxies.update(self.template.proxies)
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            self.local.session = session
+        return session
+
+    def __getattr__(self, name):
+        return getattr(self._session(), name)
+
+
+# Number of hosts to keep connection pools for: the Confluence site plus, e.g., the media host
+# that attachment downloads redirect to, so that downloads do not evict the site's pool
+POOLED_HOSTS = 4
+
+
+def configure_session(
+    api: Confluence, *, pool_size: int, keep_alive: bool = True, compression: bool = True
+):
+    """
+    Keeps up to pool_size connections alive for reuse and makes the client's session safe to use
+    from multiple threads. The pool does not block: requests beyond pool_size (e.g., from more
+    concurrent sessions than expected) open extra connections that are closed afterwards,
+    so a busy pool slows requests down rather than making them wait indefinitely.
+    """
+    adapter = HTTPAdapter(pool_connections=POOLED_HOSTS, pool_maxsize=pool_size, pool_block=False)
+    template = api._session
+    template.headers["Connection"] = "keep-alive" if keep_alive else "close"
+    template.headers["Accept-Encoding"] = "gzip, deflate" if compression else "identity"
+    api._session = ThreadLocalSession(template, adapter)
+
 
-    return Confluence(
+class RateLimitedConfluence(Confluence):
+    "Sends every request through the rate limiter shared by all Confluence clients"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = get_limiter("Confluence")
+
+    def request(self, *args, **kwargs):
+        return self.limiter.call(super().request, *args, **kwargs)
+
+
+def create_client(
+    url: str | None = None,
+    username: str | None = None,
+    api_key: str | None = None,
+    *,
+    pool_size: int = 10,
+    keep_alive: bool = True,
+    compression: bool = True,
+):
+    url, username, api_key = resolve_credentials(url, username, api_key)
+    api = RateLimitedConfluence(
         url=url,
         username=username,
         password=api_key,
+        # Let the rate limiter handle Retry-After so that all threads back off together
+        retry_with_header=False,
     )
+    configure_session(api, pool_size=pool_size, keep_alive=keep_alive, compression=compression)
+    return api
 
 
-def get_all_entities(api_call) -> list:
-    entities = []
+def iter_all_entities(api_call):
+    "Yields entities as each page of results is received"
     start = 0
     while True:
         response = api_call(start)
-        entities += response["results"]
-        logger.info("Got %r total entities", len(entities))
+        yield from response["results"]
         if not response["_links"].get("next"):
-            return entities
+            return
         limit = response["limit"]
         start += limit
 
 
+def get_all_entities(api_call) -> list:
+    entities = list(iter_all_entities(api_call))
+    logger.info("Got %r total entities", len(entities))
+    return entities
+
+
+def iter_all_entities_by_next_link(api: Confluence, path: str, params: dict):
+    "For endpoints like content/search that paginate using a cursor in the `next` link"
+    response = api.get(path, params=params)
+    while True:
+        yield from response["results"]
+        if not (next_link := response["_links"].get("next")):
+            return
+        response = api.get(f"{response['_links']['base']}{next_link}", absolute=True)
+
+
+# Page fields needed to build the page tree; extensions.position orders pages among their siblings
+PAGE_EXPAND = "history.lastUpdated,version,extensions.position"
+# Expand body.export_view -- https://stackoverflow.com/a/50959315/23458508
+BODY_EXPAND = "body.export_view"
+
+
+def page_expand(include_body: bool = False) -> str:
+    return f"{PAGE_EXPAND},{BODY_EXPAND}" if include_body else PAGE_EXPAND
+
+
+# Optional on-disk cache of Confluence responses
+CACHE_DIR = os.environ.get("CONFLUENCE_CACHE_DIR")
+CACHE_MAX_MB = int(os.environ.get("CONFLUENCE_CACHE_MAX_MB", 500))
+# Seconds before cached spaces and child page listings are queried again
+CACHE_LISTING_TTL = int(os.environ.get("CONFLUENCE_CACHE_LISTING_TTL", 600))
+
+
+class BodyCache:
+    """
+    Thread-safe LRU cache of page HTML (export_view) keyed by page id and version number,
+    so a body is only fetched again if the page has been modified.
+    If disk_cache is provided, bodies are also stored on disk.
+    """
+
+    def __init__(self, max_chars: int = 200_000_000, disk_cache: ResponseCache | None = None):
+        self.max_chars = max_chars
+        self.disk_cache = disk_cache
+        self.total_chars = 0
+        self.entries: OrderedDict[tuple[str, int], str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, page_id: str, version: int) -> str | None:
+        with self.lock:
+            html_value = self.entries.get((page_id, version))
+            if html_value is not None:
+                self.entries.move_to_end((page_id, version))
+                return html_value
+        if self.disk_cache and (html_value := self.disk_cache.get(f"body:{page_id}:{version}")):
+            self._put_in_memory(page_id, version, html_value)
+        return html_value
+
+    def put(self, page_id: str, version: int, html_value: str):
+        if self._put_in_memory(page_id, version, html_value) and self.disk_cache:
+            self.disk_cache.set(f"body:{page_id}:{version}", html_value)
+
+    def _put_in_memory(self, page_id: str, version: int, html_value: str) -> bool:
+        with self.lock:
+            if (page_id, version) in self.entries:
+                return False
+            self.entries[(page_id, version)] = html_value
+            self.total_chars += len(html_value)
+            while self.total_chars > self.max_chars and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_chars -= len(evicted)
+            return True
+
+
 class ConfluenceClient:
+    """
+    Safe to share across threads (e.g., parallel crawl and export workers in several
+    Streamlit sessions): each thread uses its own requests.Session over a shared connection pool,
+    and the caches and rate limiter are synchronized.
+    pool_size should be at least the number of threads making concurrent requests so that their
+    connections are reused.
+    """
+
     def __init__(
-        self, *, url: str | None = None, username: str | None = None, api_key: str | None = None
+        self,
+        *,
+        url: str | None = None,
+        username: str | None = None,
+        api_key: str | None = None,
+        cache_dir: str | None = CACHE_DIR,
+        pool_size: int = 10,
+        keep_alive: bool = True,
+        compression: bool = True,
     ):
-        self.api = create_client(url=url, username=username, api_key=api_key)
+        self.api = create_client(
+            url=url,
+            username=username,
+            api_key=api_key,
+            pool_size=pool_size,
+            keep_alive=keep_alive,
+            compression=compression,
+        )
+        # Identifies the user without storing the username, e.g., to keep cached responses apart
+        # since page permissions differ by user
+        self.user_hash = hashlib.sha256(f"{self.api.url}|{self.api.username}".encode()).hexdigest()
+        self.disk_cache = None
+        if cache_dir:
+            self.disk_cache = ResponseCache(
+                os.path.join(cache_dir, self.user_hash[:16]), max_bytes=CACHE_MAX_MB * 1024 * 1024
+            )
+        self.body_cache = BodyCache(disk_cache=self.disk_cache)
+
+    def _cached_listing(self, key: str, query):
+        """
+        Returns the listing from the disk cache if it is more recent than CACHE_LISTING_TTL;
+        otherwise yields entities from query() as they are received and caches them at the end.
+        """
+        if (
+            self.disk_cache
+            and (entities := self.disk_cache.get(key, CACHE_LISTING_TTL)) is not None
+        ):
+            logger.info("Using cached %r", key)
+            yield from entities
+            return
+
+        entities = []
+        for entity in query():
+            entities.append(entity)
+            yield entity
+        if self.disk_cache:
+            self.disk_cache.set(key, entities)
 
     def get_global_spaces(self, limit: int = 30):
-        return get_all_entities(
-            lambda start: self.api.get_all_spaces(
-                start=start, limit=limit, space_type="global", expand="homepage"
+        return list(
+            self._cached_listing(
+                "spaces:global",
+                lambda: get_all_entities(
+                    lambda start: self.api.get_all_spaces(
+                        start=start, limit=limit, space_type="global", expand="homepage"
+                    )
+                ),
             )
         )
 
-    def get_child_pages(self, page_id: str):
-        # TODO: use pagination
-        return list(
-            self.api.get_page_child_by_type(
-                page_id, start=None, limit=None, expand="history.lastUpdated"
+    def iter_child_pages(self, page_id: str, limit: int = 200, *, include_body=False, cached=False):
+        """
+        Yields child pages as each page of results is received.
+        If cached, the listing may come from the disk cache, so it can be up to
+        CACHE_LISTING_TTL old; crawls do not use it since they must see new pages and versions.
+        """
+
+        def query():
+            return iter_all_entities(
+                lambda start: self.api.get(
+                    f"rest/api/content/{page_id}/child/page",
+                    params={"start": start, "limit": limit, "expand": page_expand(include_body)},
+                )
             )
+
+        if include_body or not cached:
+            # Bodies are cached separately by version (see cache_page_body())
+            return query()
+        return self._cached_listing(f"children:{page_id}", query)
+
+    def get_child_pages(self, page_id: str, *, include_body=False, cached=False):
+        return list(self.iter_child_pages(page_id, include_body=include_body, cached=cached))
+
+    def iter_descendant_pages(self, page_id: str, limit: int = 250, *, include_body=False):
+        """
+        Uses CQL to query all descendants of a page, so the number of requests depends on
+        the number of pages divided by the limit rather than on the number of pages.
+        Each page includes its `ancestors` so that the page hierarchy can be reconstructed.
+        Pages are yielded as each page of results is received.
+        """
+        # https://developer.atlassian.com/cloud/confluence/advanced-searching-using-cql/#ancestor
+        return self.iter_cql_pages(
+            f"ancestor = {page_id} and type = page", limit, include_body=include_body
+        )
+
+    def iter_cql_pages(self, cql: str, limit: int = 250, *, include_body=False):
+        "Yields the pages matching the CQL query, each including its `ancestors`"
+        return iter_all_entities_by_next_link(
+            self.api,
+            "rest/api/content/search",
+            params={"cql": cql, "limit": limit, "expand": f"ancestors,{page_expand(include_body)}"},
+        )
+
+    def iter_cql_ids(self, cql: str, limit: int = 1000):
+        "Yields only the ids of the content matching the CQL query, which is cheaper to list"
+        contents = iter_all_entities_by_next_link(
+            self.api, "rest/api/content/search", params={"cql": cql, "limit": limit}
+        )
+        return (content["id"] for content in contents)
+
+    def iter_cql_versions(self, cql: str, limit: int = 250):
+        "Yields the id and current version number of the content matching the CQL query"
+        contents = iter_all_entities_by_next_link(
+            self.api,
+            "rest/api/content/search",
+            params={"cql": cql, "limit": limit, "expand": "version"},
+        )
+        return ((content["id"], content["version"]["number"]) for content in contents)
+
+    def count_cql(self, cql: str) -> int:
+        "Returns the number of results for the CQL query without listing them"
+        # https://developer.atlassian.com/cloud/confluence/rest/v1/api-group-search/
+        return self.api.get("rest/api/search", params={"cql": cql, "limit": 1})["totalSize"]
+
+    def iter_space_pages(self, space_key: str, limit: int = 250, *, include_body=False):
+        """
+        Lists every page in the space, including pages that are not under the space's homepage.
+        Like iter_descendant_pages(), each page includes its `ancestors` and pages are yielded
+        as each page of results is received, so large spaces take few requests.
+        """
+        return iter_all_entities_by_next_link(
+            self.api,
+            "rest/api/content",
+            params={
+                "spaceKey": space_key,
+                "type": "page",
+                "status": "current",
+                "limit": limit,
+                "expand": f"ancestors,{page_expand(include_body)}",
+            },
         )
 
     def list_pages(self, space: str, title: str):
         page_id = self.api.get_page_id(space, title)
-        child_pages = self.get_child_pages(page_id)
+        child_pages = self.get_child_pages(page_id, cached=True)
         return child_pages
 
+    def cache_page_body(self, page: dict):
+        "Caches the page's export_view HTML if it was expanded, e.g., while building the page tree"
+        if "body" in page and "version" in page:
+            self.body_cache.put(page["id"], page["version"]["number"], page_html(page))
+
+    def get_page_html(self, page_id: str, version: int | None = None) -> str:
+        "Returns the export_view HTML of the page, only fetching it if not cached for the version"
+        if version is None and self.disk_cache:
+            # Revalidate cheaply by querying only the page's current version
+            version = self.api.get_page_by_id(page_id, expand="version")["version"]["number"]
+        if version is not None and (html_value := self.body_cache.get(page_id, version)):
+            return html_value
+        page = self.api.get_page_by_id(page_id, expand=f"version,{BODY_EXPAND}")
+        self.cache_page_body(page)
+        return page_html(page)
+
     def export_page_html(self, page_id, folder, create_ancestor_folders=True):
-        # Expand body.export_view -- https://stackoverflow.com/a/50959315/23458508
-        page = self.api.get_page_by_id(page_id, expand="space,ancestors,body.export_view")
-        page_link = f"{page['_links']['base']}{page['_links']['webui']}"
+        page = self.api.get_page_by_id(page_id, expand=f"space,ancestors,version,{BODY_EXPAND}")
+        self.cache_page_body(page)
         if create_ancestor_folders:
-            parent_folders = [ap["title"] for ap in page["ancestors"]]
-            folder = os.path.join(folder, page["space"]["name"], *parent_folders)
-        os.makedirs(folder, exist_ok=True)
-
-        html_value = page["body"]["export_view"]["value"]
-        tree = BeautifulSoup(html_value, "html.parser")
-        valid_filename = re.sub(r"/", "_", page["title"].strip())
-        html_filename = os.path.join(folder, f"{valid_filename}.html")
-        logger.info("Saving %r", html_filename)
-        with open(html_filename, "w", encoding="utf-8") as f:
-            f.write(f"(Source: <a href={page_link}>{page['title']}</a>)")
-            f.write(tree.prettify())
-
-        return html_filename
+            folder = page_folder(page, folder)
+        return self.save_page_html(page["title"], page_link(page), page_html(page), folder)
+
+    def save_page_html(
+        self,
+        title: str,
+        page_link: str,
+        html_value: str,
+        folder: str,
+        rewrite_url: RewriteUrl | None = None,
+    ):
+        return save_page_html(title, page_link, html_value, folder, rewrite_url)
+
+    def open_download(self, url: str) -> requests.Response:
+        "Starts streaming a download (e.g., an attachment); use the response as a context manager"
+
+        def get():
+            response = self.api._session.get(url, stream=True, timeout=self.api.timeout)
+            if not response.ok:
+                # Callers only close successful responses, so release the pooled connection
+                # before raising (including for throttled responses that are retried)
+                response.close()
+                response.raise_for_status()
+            return response
+
+        return self.api.limiter.call(get)
+
+
+def save_page_html(
+    title: str,
+    page_link: str,
+    html_value: str,
+    folder: str,
+    rewrite_url: RewriteUrl | None = None,
+) -> tuple[str, bool]:
+    "Returns the HTML filename and whether it was written, i.e., its content changed"
+    os.makedirs(folder, exist_ok=True)
+    html_filename = page_html_filename(folder, title)
+
+    written = write_if_changed(
+        html_filename, lambda f: write_page_html(f, title, page_link, html_value, rewrite_url)
+    )
+    logger.info("%s %r", "Saved" if written else "Unchanged", html_filename)
+    return html_filename, written
+
+
+def write_page_html(
+    f, title: str, page_link: str, html_value: str, rewrite_url: RewriteUrl | None = None
+):
+    "Writes the page's HTML, preceded by a link to the page, to the text stream f"
+    f.write(f"(Source: <a href={page_link}>{title}</a>)")
+    get_serializer()(html_value, f, rewrite_url)
+
+
+class HashingWriter:
+    "Encodes and hashes text as it is written to a binary file"
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def write(self, s: str) -> int:
+        data = s.encode("utf-8")
+        self.sha.update(data)
+        return self.f.write(data)
+
+
+def write_if_changed(path: str, write: Callable[[HashingWriter], None]) -> bool:
+    """
+    Writes the file with atomic_write(). If the content is identical to the existing file,
+    the existing file (and its modification time) is left as is and False is returned.
+    """
+    writers = []
+
+    def write_hashed(f):
+        writers.append(HashingWriter(f))
+        write(writers[-1])
+
+    def replace_if_changed(tmp_path: str, path: str) -> bool:
+        if (
+            os.path.isfile(path)
+            and os.path.getsize(path) == os.path.getsize(tmp_path)
+            and file_hash(path) == writers[-1].sha.hexdigest()
+        ):
+            return False
+        return replace_file(tmp_path, path)
+
+    return atomic_write(path, write_hashed, mode="wb", replace=replace_if_changed)
+
+
+def page_html(page: dict) -> str:
+    return page["body"]["export_view"]["value"]
+
+
+def page_link(page: dict) -> str:
+    return f"{page['_links']['base']}{page['_links']['webui']}"
+
+
+def page_folder(page: dict, export_folder: str) -> str:
+    "Returns the folder for the page's HTML file based on the page's space and ancestors"
+    parent_folders = [ap["title"] for ap in page["ancestors"]]
+    return os.path.join(export_folder, page["space"]["name"], *parent_folders)
+
+
+def page_html_filename(folder: str, title: str) -> str:
+    valid_filename = re.sub(r"/", "_", title.strip())
+    return os.path.join(folder, f"{valid_filename}.html")
@@ -0,0 +1,161 @@
+import io
+import logging
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+from typing import BinaryIO, Callable
+
+logger = logging.getLogger(__name__)
+
+# Archive format -> filename suffix
+ARCHIVE_FORMATS = {"zip": ".zip", "tar": ".tar"}
+
+
+def archive_path(export_folder: str, archive_format: str) -> str:
+    "E.g., ./exports/<profile>.zip for the ./exports/<profile> export folder"
+    return f"{export_folder.rstrip('/')}{ARCHIVE_FORMATS[archive_format]}"
+
+
+def archive_format_of(path: str) -> str | None:
+    for archive_format, suffix in ARCHIVE_FORMATS.items():
+        if path.endswith(suffix):
+            return archive_format
+    return None
+
+
+class ArchiveWriter:
+    """
+    Writes exported files into a zip or tar archive instead of a folder, with the folder
+    structure kept as paths within the archive. Files can be written from multiple threads.
+    The archive is written to a temporary file that replaces the archive when closed,
+    so a failed export leaves the previous archive as is.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.archive_format = archive_format_of(path)
+        if not self.archive_format:
+            raise ValueError(f"Unsupported archive: {path!r}")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.tmp_path = f"{path}.tmp"
+        if self.archive_format == "zip":
+            self.archive = zipfile.ZipFile(self.tmp_path, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(self.tmp_path, "w")
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(commit=exc_type is None)
+
+    def write(self, name: str, write: Callable[[BinaryIO], None]):
+        "Adds a file named name to the archive with the content written by write()"
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # Only one file can be written to a ZipFile at a time, but it is streamed
+            with self.lock, self.archive.open(info, "w") as f:
+                write(f)
+        else:
+            # Tar headers include the size, so the content is written to memory first
+            buffer = io.BytesIO()
+            write(buffer)
+            info = tarfile.TarInfo(name)
+            info.size = buffer.tell()
+            info.mtime = int(time.time())
+            buffer.seek(0)
+            with self.lock:
+                self.archive.addfile(info, buffer)
+
+    def close(self, commit: bool = True):
+        self.archive.close()
+        if commit:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+class LocalFolder:
+    "Reads exported files from a folder; see ExportArchive"
+
+    def listdir(self, path: str) -> list[str]:
+        return os.listdir(path)
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    def isfile(self, path: str) -> bool:
+        return os.path.isfile(path)
+
+    def getsize(self, path: str) -> int:
+        return os.path.getsize(path)
+
+    def open(self, path: str) -> BinaryIO:
+        return open(path, "rb")
+
+
+class ExportArchive:
+    """
+    Reads exported files from an archive written by ArchiveWriter, with the same methods as
+    LocalFolder so that callers can read from either. Paths are relative to the archive's root,
+    which is "".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.archive_format = archive_format_of(path)
+        if self.archive_format == "zip":
+            self.archive = zipfile.ZipFile(path)
+            sizes = {i.filename: i.file_size for i in self.archive.infolist() if not i.is_dir()}
+        elif self.archive_format == "tar":
+            self.archive = tarfile.open(path)
+            self.members = {m.name: m for m in self.archive.getmembers() if m.isfile()}
+            sizes = {name: m.size for name, m in self.members.items()}
+        else:
+            raise ValueError(f"Unsupported archive: {path!r}")
+        self.lock = threading.Lock()
+        self.sizes = sizes
+        # Folder path -> names of the files and folders in it
+        self.folders: dict[str, set[str]] = {"": set()}
+        for name in sizes:
+            folder, filename = posixpath.split(name)
+            self.folders.setdefault(folder, set()).add(filename)
+            while folder:
+                parent, folder_name = posixpath.split(folder)
+                self.folders.setdefault(parent, set()).add(folder_name)
+                folder = parent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.archive.close()
+
+    def listdir(self, path: str) -> list[str]:
+        return sorted(self.folders[path.strip("/")])
+
+    def isdir(self, path: str) -> bool:
+        return path.strip("/") in self.folders
+
+    def isfile(self, path: str) -> bool:
+        return path in self.sizes
+
+    def getsize(self, path: str) -> int:
+        return self.sizes[path]
+
+    def open(self, path: str) -> BinaryIO:
+        # Read into memory since archive members cannot be read by multiple threads at once
+        with self.lock:
+            if self.archive_format == "zip":
+                data = self.archive.read(path)
+            else:
+                data = self.archive.extractfile(self.members[path]).read()
+        return io.BytesIO(data)
+
+    def html_files(self) -> list[str]:
+        return sorted(name for name in self.sizes if name.endswith(".html"))
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from atomic_write import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Hidden so that it is not uploaded to GDrive
+MANIFEST_FILENAME = ".export_manifest.json"
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ExportManifest:
+    """
+    Records the page and version exported to each file in an export folder,
+    so that a later export can skip pages that have not changed.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        # Keyed by the output path relative to the export folder
+        self.entries: dict[str, dict] = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.entries = json.load(f)["files"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Ignoring unreadable manifest %r: %s", self.path, e)
+
+    def is_unchanged(self, node, output_path: str) -> bool:
+        "Returns True if the node's version was previously exported to output_path"
+        rel_path = os.path.relpath(output_path, self.folder)
+        with self.lock:
+            entry = self.entries.get(rel_path)
+        return bool(
+            entry
+            and node.version is not None
+            and entry["page_id"] == node.id
+            and entry["version"] == node.version
+            and os.path.isfile(output_path)
+        )
+
+    def record(self, node, output_path: str):
+        rel_path = os.path.relpath(output_path, self.folder)
+        entry = {
+            "page_id": node.id,
+            "version": node.version,
+            "last_updated": node.modified.isoformat(),
+            "content_hash": file_hash(output_path),
+            "output_path": rel_path,
+        }
+        with self.lock:
+            self.entries[rel_path] = entry
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"files": self.entries}, indent=1, sort_keys=True)
+        atomic_write(self.path, lambda f: f.write(data))
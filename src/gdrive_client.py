@@ -1,18 +1,36 @@
 import os
 import logging
 import json
+import posixpath
+import threading
+from typing import Any, Iterator
 
 import googleapiclient.errors
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
 
+from export_archive import LocalFolder
+from rate_limit import get_limiter, is_google_throttled
+
 logger = logging.getLogger(__name__)
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Maximum pageSize of files().list
+MAX_PAGE_SIZE = 1000
+# The file metadata used when syncing, instead of the default fields
+FILE_FIELDS = "id, name, mimeType, modifiedTime, md5Checksum, appProperties"
+# Number of folders whose files are listed by each query when indexing a folder tree,
+# which keeps the query string to a few KB
+PARENTS_PER_QUERY = 50
+# Maximum number of requests in each call to the batch endpoint
+# https://developers.google.com/workspace/drive/api/guides/performance#batch-requests
+MAX_BATCH_SIZE = 100
+
 
-def get_service(account_info: dict | None = None, *, account_file: str | None = None):
+def get_credentials(account_info: dict | None = None, *, account_file: str | None = None):
     if account_info is None:
         if account_file is None:
             account_file = os.environ.get("SERVICE_ACCOUNT_FILE")
@@ -23,21 +41,24 @@ def get_service(account_info: dict | None = None, *, account_file: str | None =
     if not account_info:
         raise ValueError("No account info or file provided")
 
-    creds = service_account.Credentials.from_service_account_info(account_info, scopes=SCOPES)
+    return service_account.Credentials.from_service_account_info(account_info, scopes=SCOPES)
+
+
+def get_service(credentials):
     # https://googleapis.github.io/google-api-python-client/docs/dyn/drive_v3.html
-    return build("drive", "v3", credentials=creds)
+    return build("drive", "v3", credentials=credentials)
 
 
-def get_all_pages_using_next_page_token(api_call) -> list:
-    files = []
+def iter_files_using_next_page_token(api_call) -> Iterator[dict]:
+    "Yields the files in each page of results, requesting the next page when needed"
     next_page_token = None
     while True:
         # https://developers.google.com/workspace/drive/api/reference/rest/v3/files/list
         response = api_call(next_page_token)
-        files += response.get("files", [])
+        yield from response.get("files", [])
         next_page_token = response.get("nextPageToken")
         if not next_page_token:
-            return files
+            return
 
 
 SUPPORTED_MIME_TYPES = {
@@ -57,43 +78,153 @@ SUPPORTED_MIME_TYPES = {
 TYPES_TO_CONVERT = ["txt", "html", "docx", "xlsx", "pptx", "rtf", "odt"]
 
 
+class DriveFolderIndex:
+    """
+    The files and folders in a GDrive folder tree, listed level by level with a few large
+    queries instead of one query per folder. Paths are relative to the root folder, which is "".
+    """
+
+    def __init__(self, root_id: str):
+        self.root_id = root_id
+        # Folder path -> folder ID
+        self.folder_ids: dict[str, str] = {"": root_id}
+        # Folder path -> files and folders in it
+        self.contents: dict[str, list[dict]] = {"": []}
+
+    def add(self, folder_path: str, gfile: dict):
+        "Adds gfile to the folder at folder_path, registering it if it is a folder"
+        self.contents[folder_path].append(gfile)
+        if gfile["mimeType"] == FOLDER_MIME_TYPE:
+            path = posixpath.join(folder_path, gfile["name"])
+            self.folder_ids[path] = gfile["id"]
+            self.contents[path] = []
+
+    def files_in(self, folder_path: str) -> list[dict]:
+        return self.contents.get(folder_path, [])
+
+    def files_by_name(self, folder_path: str) -> dict[str, dict]:
+        "Files (not folders) in the folder at folder_path by name"
+        return {
+            f["name"]: f for f in self.files_in(folder_path) if f["mimeType"] != FOLDER_MIME_TYPE
+        }
+
+    def folder_id(self, path: str) -> str | None:
+        return self.folder_ids.get(path)
+
+
 class GDriveClient:
-    def __init__(self, account_info: dict | None = None, *, service_account_file: str | None = None):
-        self.service = get_service(account_info, account_file=service_account_file)
-        self.files_svc = self.service.files()
+    def __init__(
+        self, account_info: dict | None = None, *, service_account_file: str | None = None
+    ):
+        self.credentials = get_credentials(account_info, account_file=service_account_file)
+        # The service and its HTTP transport are not thread-safe, so each thread builds its own
+        # https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
+        self.local = threading.local()
+        # Shared by all GDriveClient instances
+        self.limiter = get_limiter("GDrive")
+
+    @property
+    def service(self):
+        "The calling thread's Drive service"
+        if not hasattr(self.local, "service"):
+            self.local.service = get_service(self.credentials)
+        return self.local.service
+
+    @property
+    def files_svc(self):
+        if not hasattr(self.local, "files_svc"):
+            self.local.files_svc = self.service.files()
+        return self.local.files_svc
 
-    def files_in_folder(self, folder_id) -> list[dict]:
+    def execute(self, request):
+        "Executes the API request through the rate limiter"
+        return self.limiter.call(request.execute)
+
+    def files_in_folder(self, folder_id) -> Iterator[dict]:
+        "Yields the files and folders in the folder, listed in pages of up to MAX_PAGE_SIZE"
         # https://stackoverflow.com/questions/24720075/how-to-get-list-of-files-by-folder-on-google-drive-api
         # https://stackoverflow.com/questions/69533918/how-do-i-search-google-drive-api-by-date
-        return get_all_pages_using_next_page_token(
-            lambda next_page_token: self.files_svc.list(
-                q=f"'{folder_id}' in parents and trashed=false",
-                pageToken=next_page_token,
-            ).execute()
+        return iter_files_using_next_page_token(
+            lambda next_page_token: self.execute(
+                self.files_svc.list(
+                    q=f"'{folder_id}' in parents and trashed=false",
+                    fields=f"nextPageToken, files({FILE_FIELDS})",
+                    pageSize=MAX_PAGE_SIZE,
+                    pageToken=next_page_token,
+                )
+            )
         )
 
+    def index_folder_tree(self, folder_id: str) -> DriveFolderIndex:
+        """
+        Lists all files and folders under folder_id, querying the children of up to
+        PARENTS_PER_QUERY folders at a time. Hidden folders are not descended into.
+        """
+        index = DriveFolderIndex(folder_id)
+        level = {folder_id: ""}
+        num_queries = 0
+        while level:
+            next_level = {}
+            parent_ids = list(level)
+            for start in range(0, len(parent_ids), PARENTS_PER_QUERY):
+                batch = parent_ids[start : start + PARENTS_PER_QUERY]
+                parents_q = " or ".join(f"'{parent_id}' in parents" for parent_id in batch)
+                gfiles = iter_files_using_next_page_token(
+                    lambda next_page_token: self.execute(
+                        self.files_svc.list(
+                            q=f"({parents_q}) and trashed=false",
+                            fields=f"nextPageToken, files({FILE_FIELDS}, parents)",
+                            pageSize=MAX_PAGE_SIZE,
+                            pageToken=next_page_token,
+                        )
+                    )
+                )
+                num_queries += 1
+                for gfile in gfiles:
+                    for parent_id in gfile.get("parents", []):
+                        if parent_id not in level:
+                            continue
+                        index.add(level[parent_id], gfile)
+                        if gfile["mimeType"] == FOLDER_MIME_TYPE and not gfile["name"].startswith(
+                            "."
+                        ):
+                            next_level[gfile["id"]] = posixpath.join(
+                                level[parent_id], gfile["name"]
+                            )
+            level = next_level
+        logger.info(
+            "Indexed %i GDrive folders under %r with %i queries",
+            len(index.folder_ids),
+            folder_id,
+            num_queries,
+        )
+        return index
+
     def create_drive_folder(self, folder_name: str, parent_id: str):
         request_body = {
             "name": folder_name,
-            "mimeType": "application/vnd.google-apps.folder",
+            "mimeType": FOLDER_MIME_TYPE,
             "parents": [parent_id],
         }
-        return self.files_svc.create(body=request_body).execute()
+        return self.execute(self.files_svc.create(body=request_body))
 
-    def upload_to_google_drive(self, src_file, folder_id, target_filename, file_id=None):
+    def upload_to_google_drive(
+        self, src_file, folder_id, target_filename, file_id=None, *, source=LocalFolder()
+    ):
         """
         Uploads and imports a file to Google Drive.
         Google's document file import/conversion is better than Python libraries.
         If file_id is not None, the file will be updated; otherwise, a new file will be created.
+        src_file is read from source, e.g., an ExportArchive.
         """
         file_extension = os.path.splitext(src_file)[1][1:]
         if file_extension not in SUPPORTED_MIME_TYPES:
             raise ValueError(f"Unsupported file type: {file_extension}")
-        file_size = os.path.getsize(src_file)
+        file_size = source.getsize(src_file)
         if file_size > 10 * 1024 * 1024:  # 10 MB
             raise ValueError("File size exceeds the limit of 10 MB")
         media = MediaIoBaseUpload(
-            open(src_file, mode="rb"),
+            source.open(src_file),
             mimetype=SUPPORTED_MIME_TYPES[file_extension],
             # https://developers.google.com/workspace/drive/api/guides/manage-uploads
             resumable=file_size > 5 * 1024 * 1024,  # if larger than 5 MB
@@ -136,18 +267,79 @@ class GDriveClient:
             logger.info("Resumable upload for %r", src_file)
             response = None
             while response is None:
-                status, response = request.next_chunk()
+                status, response = self.limiter.call(request.next_chunk)
                 if status:
                     logger.info("Uploaded %i.", int(status.progress() * 100))
             logger.info("Upload Complete!")
             return response
         else:
-            response = request.execute()
+            response = self.execute(request)
             return response
 
+    def execute_batch(self, requests: list) -> list[tuple[Any, Exception | None]]:
+        """
+        Executes the requests through the batch endpoint, up to MAX_BATCH_SIZE per HTTP request,
+        and returns a (response, error) pair for each request instead of raising its error.
+        Throttled requests are retried through the rate limiter without repeating the others.
+        """
+        results: list[tuple[Any, Exception | None]] = [(None, None)] * len(requests)
+        for start in range(0, len(requests), MAX_BATCH_SIZE):
+            pending = set(range(start, min(start + MAX_BATCH_SIZE, len(requests))))
+
+            def execute_pending():
+                throttled_error = None
+
+                def callback(request_id, response, exception):
+                    nonlocal throttled_error
+                    if exception is not None and is_google_throttled(exception):
+                        throttled_error = exception
+                        return
+                    results[int(request_id)] = (response, exception)
+                    pending.discard(int(request_id))
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for i in sorted(pending):
+                    batch.add(requests[i], request_id=str(i))
+                batch.execute()
+                if throttled_error:
+                    raise throttled_error
+
+            try:
+                self.limiter.call(execute_pending)
+            except googleapiclient.errors.HttpError as e:
+                for i in pending:
+                    results[i] = (None, e)
+        return results
+
+    def create_drive_folders(
+        self, folders: list[tuple[str, str]]
+    ) -> list[tuple[dict | None, Exception | None]]:
+        "Creates the (folder_name, parent_id) folders in batches; see execute_batch()"
+        return self.execute_batch(
+            [
+                self.files_svc.create(
+                    body={"name": folder_name, "mimeType": FOLDER_MIME_TYPE, "parents": [parent_id]}
+                )
+                for folder_name, parent_id in folders
+            ]
+        )
+
+    def delete_files(self, file_ids: list[str]) -> list[bool]:
+        "Deletes the files in batches, returning whether each was deleted"
+        results = self.execute_batch(
+            [self.files_svc.delete(fileId=file_id) for file_id in file_ids]
+        )
+        for file_id, (_, error) in zip(file_ids, results):
+            if error:
+                logger.warning("Error deleting (%s) from GDrive: %s", file_id, error)
+        logger.info(
+            "Deleted %i of %i files from GDrive", sum(not e for _, e in results), len(results)
+        )
+        return [not error for _, error in results]
+
     def delete_file(self, file_id):
         try:
-            self.files_svc.delete(fileId=file_id).execute()
+            self.execute(self.files_svc.delete(fileId=file_id))
             logger.info("Deleted %r from GDrive", file_id)
             return True
         except googleapiclient.errors.HttpError as e:
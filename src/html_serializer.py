@@ -0,0 +1,149 @@
+import html
+import logging
+import os
+from html.entities import html5, name2codepoint
+from html.parser import HTMLParser
+from typing import Callable, TextIO
+
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+# Elements that have no end tag
+VOID_ELEMENTS = frozenset(
+    "area base br col embed hr img input link meta param source track wbr".split()
+)
+# Elements whose content HTMLParser passes through unparsed
+RAW_TEXT_ELEMENTS = frozenset(["script", "style"])
+# The link attribute of each tag that rewrite_url is called for
+LINK_ATTRS = {"img": "src", "a": "href"}
+
+# Called with (tag, url) and returns the url to write
+RewriteUrl = Callable[[str, str], str]
+
+
+class StreamingHtmlWriter(HTMLParser):
+    """
+    Re-serializes HTML to `out` as it is parsed, without building a document tree.
+    Like BeautifulSoup's html.parser tree builder, it quotes and escapes attributes,
+    drops stray end tags, and closes tags that were left open, but it does not add whitespace.
+    Only the currently open tags and HTMLParser's unparsed input are held in memory.
+    If rewrite_url is given, it is called with each link in LINK_ATTRS and returns its new value.
+    """
+
+    def __init__(self, out: TextIO, rewrite_url: RewriteUrl | None = None):
+        super().__init__(convert_charrefs=False)
+        self.out = out
+        self.rewrite_url = rewrite_url
+        self.open_tags: list[str] = []
+
+    def _write_tag(self, tag: str, attrs: list[tuple[str, str | None]], self_closing: bool):
+        if self.rewrite_url and (link_attr := LINK_ATTRS.get(tag)):
+            attrs = [
+                (name, self.rewrite_url(tag, value) if name == link_attr and value else value)
+                for name, value in attrs
+            ]
+        attrs_str = "".join(
+            f" {name}" if value is None else f' {name}="{html.escape(value)}"'
+            for name, value in attrs
+        )
+        self.out.write(f"<{tag}{attrs_str}{'/>' if self_closing else '>'}")
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            self._write_tag(tag, attrs, self_closing=True)
+        else:
+            self._write_tag(tag, attrs, self_closing=False)
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            self._write_tag(tag, attrs, self_closing=True)
+        else:
+            self._write_tag(tag, attrs, self_closing=False)
+            self.out.write(f"</{tag}>")
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        # Close any tags that were left open inside this one
+        while (open_tag := self.open_tags.pop()) != tag:
+            self.out.write(f"</{open_tag}>")
+        self.out.write(f"</{tag}>")
+
+    def handle_data(self, data):
+        if self.open_tags and self.open_tags[-1] in RAW_TEXT_ELEMENTS:
+            self.out.write(data)
+        else:
+            self.out.write(html.escape(data, quote=False))
+
+    def handle_entityref(self, name):
+        if name in name2codepoint or f"{name};" in html5:
+            self.out.write(f"&{name};")
+        else:
+            self.out.write(f"&amp;{name}")
+
+    def handle_charref(self, name):
+        self.out.write(f"&#{name};")
+
+    def handle_comment(self, data):
+        self.out.write(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self.out.write(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self.out.write(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        # HTMLParser passes "CDATA[x" for <![CDATA[x]]> and "if IE" for <![if IE]>
+        if data.startswith("CDATA["):
+            self.out.write(f"<![{data}]]>")
+        else:
+            self.out.write(f"<![{data}]>")
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.out.write(f"</{self.open_tags.pop()}>")
+
+
+def write_streaming(
+    html_value: str,
+    out: TextIO,
+    rewrite_url: RewriteUrl | None = None,
+    *,
+    chunk_size: int = 64 * 1024,
+):
+    writer = StreamingHtmlWriter(out, rewrite_url)
+    for start in range(0, len(html_value), chunk_size):
+        writer.feed(html_value[start : start + chunk_size])
+    writer.close()
+
+
+def write_prettified(html_value: str, out: TextIO, rewrite_url: RewriteUrl | None = None):
+    "The original serializer, which builds a BeautifulSoup tree and indents every element"
+    tree = BeautifulSoup(html_value, "html.parser")
+    if rewrite_url:
+        for tag, link_attr in LINK_ATTRS.items():
+            for element in tree.find_all(tag, attrs={link_attr: True}):
+                element[link_attr] = rewrite_url(tag, element[link_attr])
+    out.write(tree.prettify())
+
+
+Serializer = Callable[[str, TextIO, RewriteUrl | None], None]
+
+SERIALIZERS: dict[str, Serializer] = {
+    "stream": write_streaming,
+    "prettify": write_prettified,
+}
+
+HTML_SERIALIZER = os.environ.get("HTML_SERIALIZER", "stream")
+
+
+def get_serializer(name: str | None = None) -> Serializer:
+    "Returns the serializer with the given name, defaulting to the HTML_SERIALIZER setting"
+    name = name or HTML_SERIALIZER
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown HTML serializer {name!r}; choose from {sorted(SERIALIZERS)}")
+    return SERIALIZERS[name]
@@ -1,13 +1,32 @@
+import asyncio
 import functools
 import logging
 import os
-from datetime import datetime
+import posixpath
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from queue import Queue
+from typing import Callable, Iterable
 
-from anytree import Node, PreOrderIter
+from anytree import Node
+from atlassian.errors import ApiError
 from dotenv import load_dotenv
+from requests import HTTPError
 
-from confluence_client import ConfluenceClient
+from attachment_store import ATTACHMENT_MAX_WORKERS, AttachmentStore
+from confluence_client import (
+    ConfluenceClient,
+    HashingWriter,
+    page_expand,
+    page_html_filename,
+    save_page_html,
+    write_page_html,
+)
+from export_archive import ArchiveWriter, LocalFolder
+from export_manifest import ExportManifest
+from page_tree import EPOCH, Page, PageTree, from_timestamp
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -16,20 +35,108 @@ logger.setLevel(logging.DEBUG)
 load_dotenv()
 load_dotenv(dotenv_path=".env_local", override=True)
 
+# Maximum number of concurrent Confluence requests when crawling the page hierarchy
+CRAWL_MAX_WORKERS = int(os.environ.get("CRAWL_MAX_WORKERS", 8))
+# Maximum number of pages exported concurrently
+EXPORT_MAX_WORKERS = int(os.environ.get("EXPORT_MAX_WORKERS", 8))
+# Maximum number of files uploaded to GDrive concurrently
+GDRIVE_UPLOAD_WORKERS = int(os.environ.get("GDRIVE_UPLOAD_WORKERS", 4))
+# "sync" uses ConfluenceClient with worker threads;
+# "async" uses AsyncConfluenceClient, which requires the optional httpx dependency
+CONFLUENCE_BACKEND = os.environ.get("CONFLUENCE_BACKEND", "sync")
+# Maximum number of pooled connections (i.e., concurrent requests) for the "async" backend
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 100))
+
+
+# Connections to pool for the Confluence client, which is shared by the crawl, export and
+# attachment download workers of all sessions
+CONFLUENCE_POOL_SIZE = int(
+    os.environ.get(
+        "CONFLUENCE_POOL_SIZE", CRAWL_MAX_WORKERS + EXPORT_MAX_WORKERS + ATTACHMENT_MAX_WORKERS
+    )
+)
+# Set to "false" to close connections after each request or to request uncompressed responses
+CONFLUENCE_KEEP_ALIVE = os.environ.get("CONFLUENCE_KEEP_ALIVE", "true").lower() == "true"
+CONFLUENCE_COMPRESSION = os.environ.get("CONFLUENCE_COMPRESSION", "true").lower() == "true"
+
 
 @functools.cache
 def create_confluence_client(
-    url: str | None, username: str | None, api_key: str | None
+    url: str | None,
+    username: str | None,
+    api_key: str | None,
+    *,
+    pool_size: int = CONFLUENCE_POOL_SIZE,
+    keep_alive: bool = CONFLUENCE_KEEP_ALIVE,
+    compression: bool = CONFLUENCE_COMPRESSION,
 ) -> ConfluenceClient:
-    return ConfluenceClient(url=url, username=username, api_key=api_key)
+    "Cached so that the client (and its connection pool) is shared by all sessions and threads"
+    return ConfluenceClient(
+        url=url,
+        username=username,
+        api_key=api_key,
+        pool_size=pool_size,
+        keep_alive=keep_alive,
+        compression=compression,
+    )
+
+
+# Fields of the root page needed by query_pages_as_tree()
+ROOT_PAGE_EXPAND = f"space,ancestors,{page_expand(include_body=True)}"
+# CQL dates are in the user's timezone, so refresh_tree() looks back far enough for any timezone
+REFRESH_LOOKBACK = timedelta(days=1)
+# Number of ids per CQL `id in (...)` query
+CQL_IDS_PER_QUERY = 100
+# Seconds after a tree was queried before exporting it checks the current versions of its pages,
+# so that cached bodies of older versions are not exported
+EXPORT_VERSION_MAX_AGE = int(os.environ.get("EXPORT_VERSION_MAX_AGE", 60))
+
+
+class CrawlProgress:
+    "Reports the partially built tree to an optional callback as pages are added to it"
+
+    def __init__(self, root_node: Node, callback: Callable[[Node, int], None] | None = None):
+        self.root_node = root_node
+        self.callback = callback
+        self.page_count = 1
+
+    def pages_added(self, count: int):
+        self.page_count += count
+        if self.callback:
+            self.callback(self.root_node, self.page_count)
+
+    def reset(self):
+        self.page_count = 1
+        if self.callback:
+            self.callback(self.root_node, self.page_count)
 
 
 class ConfluenceOps:
     def __init__(
-        self, *, url: str | None = None, username: str | None = None, api_key: str | None = None
+        self,
+        *,
+        url: str | None = None,
+        username: str | None = None,
+        api_key: str | None = None,
+        backend: str = CONFLUENCE_BACKEND,
     ):
+        if backend not in ("sync", "async"):
+            raise ValueError(f"Unknown Confluence backend: {backend!r}")
+        self.backend = backend
+        self.credentials = {"url": url, "username": username, "api_key": api_key}
         self.cclient = create_confluence_client(url=url, username=username, api_key=api_key)
 
+    def _create_async_client(self):
+        # Imported here since httpx is an optional dependency
+        from async_confluence_client import AsyncConfluenceClient
+
+        # Share the body cache so that bodies fetched by either client are reused
+        return AsyncConfluenceClient(
+            **self.credentials,
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            body_cache=self.cclient.body_cache,
+        )
+
     def confluence_api_url(self):
         return self.cclient.api.url
 
@@ -59,62 +166,774 @@ class ConfluenceOps:
             for p in pages
         ]
 
-    def query_pages_as_tree(self, space_key, page_title):
+    def query_pages_as_tree(
+        self,
+        space_key,
+        page_title,
+        *,
+        max_workers: int = CRAWL_MAX_WORKERS,
+        use_cql: bool = True,
+        prefetch_bodies: bool = False,
+        on_progress: Callable[[Node, int], None] | None = None,
+        modified_after: datetime | None = None,
+    ) -> PageTree:
+        """
+        Builds a PageTree of the page and its subpages.
+        If modified_after is given, only the pages modified since then are queried, using a
+        CQL search, along with their ancestors as stubs; see _query_modified_pages_as_tree().
+        If use_cql, all subpages are queried in bulk using a CQL search;
+        otherwise (or if the CQL search fails), the child pages of each page are queried.
+        If max_workers > 1, the child pages of each level of the hierarchy are queried concurrently.
+        With the "async" backend, up to ASYNC_MAX_CONNECTIONS requests are made concurrently instead.
+        If prefetch_bodies, the HTML of every page is fetched while building the tree and
+        cached for export_html_folder(); otherwise only the root page's HTML is cached.
+        While the tree is being built, on_progress(root_node, page_count) is called
+        (in the calling thread) with the partial tree as pages are added.
+        If page_title is blank, every page in the space is listed under a virtual root node
+        for the space; see _query_space_as_node_tree().
+        The tree is built as an anytree, whose partial tree is passed to on_progress.
+        """
         logger.info("space_key=%r, page_title=%r", space_key, page_title)
+        # Pages modified after this time may not be reflected in the tree
+        crawled_at = time.time()
+        if modified_after:
+            return self._query_modified_pages_as_tree(
+                space_key, page_title, modified_after, prefetch_bodies, crawled_at
+            )
+        if not page_title:
+            root_node = self._query_space_as_node_tree(
+                space_key, prefetch_bodies=prefetch_bodies, on_progress=on_progress
+            )
+        elif self.backend == "async":
+            root_node = asyncio.run(
+                self._async_query_pages_as_tree(
+                    space_key, page_title, use_cql, prefetch_bodies, on_progress
+                )
+            )
+        else:
+            root_node = self._query_pages_as_node_tree(
+                space_key, page_title, max_workers, use_cql, prefetch_bodies, on_progress
+            )
+        return PageTree.from_node(root_node, self.cclient.api.url, crawled_at)
+
+    def refresh_tree(self, tree: PageTree, space_key: str) -> PageTree:
+        """
+        Updates a tree from query_pages_as_tree() in place with the pages modified since it was
+        queried, so that refreshing a large tree takes a few requests instead of a crawl.
+        Deleted pages, and pages moved into or out of the tree without being modified,
+        are reconciled by listing the ids of all pages in scope (1000 per request), since the
+        number of pages can stay the same when, e.g., one page is deleted and another moved in.
+        Returns the tree.
+        """
+        crawled_at = time.time()
+        root_page = None
+        if not tree.virtual_root:
+            root_page = self.cclient.api.get_page_by_id(
+                tree.ids[0], expand=f"space,ancestors,{page_expand()}"
+            )
+            tree.space_name = root_page["space"]["name"]
+            tree.ancestor_titles = [ap["title"] for ap in root_page["ancestors"]]
+        scope_cql = tree_scope_cql(tree, 0, space_key)
+
+        since = from_timestamp(tree.crawled_at) - REFRESH_LOOKBACK
+        changed_pages = list(
+            self.cclient.iter_cql_pages(f"{scope_cql} and {lastmodified_cql(since)}")
+        )
+        logger.info("%i pages modified since %s", len(changed_pages), since)
+        if root_page:
+            changed_pages.append(root_page)
+        self._update_tree(tree, changed_pages)
+
+        # Neither the root nor stubs are counted by the CQL query
+        tree_ids = set(tree.ids[1:]) - tree.stub_ids
+        page_ids = set(self.cclient.iter_cql_ids(scope_cql))
+        if page_ids != tree_ids:
+            logger.info("Reconciling %i pages with %i in Confluence", len(tree_ids), len(page_ids))
+            deleted_ids = tree_ids - page_ids
+            # Pages under deleted pages have moved, so their new parents are queried
+            moved_ids = {
+                tree.ids[i]
+                for i in range(1, len(tree))
+                if tree.ids[tree.parents[i]] in deleted_ids and tree.ids[i] not in deleted_ids
+            }
+            query_ids = sorted((page_ids - tree_ids) | moved_ids)
+            queried_pages = [
+                page
+                for start in range(0, len(query_ids), CQL_IDS_PER_QUERY)
+                for page in self.cclient.iter_cql_pages(
+                    f"id in ({','.join(query_ids[start : start + CQL_IDS_PER_QUERY])})"
+                )
+            ]
+            self._update_tree(tree, queried_pages, deleted_ids)
+        tree.crawled_at = crawled_at
+        return tree
+
+    def _query_modified_pages_as_tree(
+        self, space_key, page_title, modified_after: datetime, prefetch_bodies, crawled_at
+    ) -> PageTree:
+        """
+        Queries only the pages modified after modified_after, so that stale branches are not
+        crawled. Each page's ancestors are added as stubs, whose other descendants are not
+        queried; count_stale_pages() counts them.
+        """
+        if page_title:
+            page_id = self.cclient.api.get_page_id(space_key, page_title)
+            page = self.cclient.api.get_page_by_id(page_id, expand=ROOT_PAGE_EXPAND)
+            root_node = self._create_root_node(page)
+        else:
+            root_node = self._create_space_root_node(space_key)
+        tree = PageTree.from_node(root_node, self.cclient.api.url, crawled_at, modified_after)
+        pages = list(
+            self.cclient.iter_cql_pages(
+                tree_scope_cql(tree, 0, space_key), include_body=prefetch_bodies
+            )
+        )
+        logger.info("%i pages modified after %s", len(pages), modified_after)
+        for page in pages:
+            self.cclient.cache_page_body(page)
+        self._update_tree(tree, pages)
+        return tree
+
+    def _update_tree(self, tree: PageTree, pages: list[dict], deleted_ids=()):
+        "Applies the pages to the tree, adding their ancestors as stubs if the tree is filtered"
+        stub_pages = []
+        if tree.modified_after is not None:
+            stub_pages = [row for p in pages for row in ancestor_stub_rows(p, tree.ids[0])]
+        tree.update((page_row(p) for p in pages), deleted_ids, stub_pages)
+
+    def count_stale_pages(
+        self, tree: PageTree, space_key: str, max_workers: int = CRAWL_MAX_WORKERS
+    ):
+        """
+        For a tree queried with modified_after, counts the descendants of the root and
+        each stub that are not in the tree, e.g., to show them on demand, into tree.stale_counts
+        """
+        indexes = [
+            i
+            for i in [0, *sorted(map(tree.index, tree.stub_ids))]
+            if tree.ids[i] not in tree.stale_counts
+        ]
+
+        def count_stale(i: int) -> int:
+            # Without the modified_after filter
+            cql = tree_scope_cql(tree, i, space_key, filtered=False)
+            return self.cclient.count_cql(cql) - tree.loaded_descendant_count(i)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="count") as executor:
+            for i, count in zip(indexes, executor.map(count_stale, indexes)):
+                tree.stale_counts[tree.ids[i]] = count
+
+    def _query_pages_as_node_tree(
+        self, space_key, page_title, max_workers, use_cql, prefetch_bodies, on_progress
+    ) -> Node:
+
         cclient = self.cclient
         page_id = cclient.api.get_page_id(space_key, page_title)
-        page = cclient.api.get_page_by_id(page_id, expand="body.export_view,history.lastUpdated")
+        page = cclient.api.get_page_by_id(page_id, expand=ROOT_PAGE_EXPAND)
+        root_node = self._create_root_node(page)
+        progress = CrawlProgress(root_node, on_progress)
+        if use_cql and self._build_tree_using_cql(root_node, progress, prefetch_bodies):
+            logger.info("Built tree using CQL search")
+        elif max_workers > 1:
+            self._build_tree_by_level(root_node, progress, prefetch_bodies, max_workers)
+        else:
+            self._recurse_build_tree(root_node, progress, prefetch_bodies)
+        return root_node
+
+    def _query_space_as_node_tree(
+        self,
+        space_key,
+        *,
+        prefetch_bodies: bool = False,
+        on_progress: Callable[[Node, int], None] | None = None,
+        on_node: Callable[[Node], None] | None = None,
+    ):
+        """
+        Builds an anytree of every page in the space under a virtual root node (which has
+        `virtual` set and is never exported). Pages are listed in large batches, regardless of
+        the hierarchy, and added to the tree as they are received; on_node(node) is called for
+        each page once it is in the tree, i.e., once its folder is known.
+        """
+        root_node = self._create_space_root_node(space_key)
+        progress = CrawlProgress(root_node, on_progress)
+        pages = self.cclient.iter_space_pages(space_key, include_body=prefetch_bodies)
+        self._add_descendant_pages(root_node, progress, pages, on_node)
+        if root_node.children:
+            root_node.modified = max(n.modified for n in root_node.descendants)
+        return root_node
+
+    def _create_space_root_node(self, space_key):
+        space = self.cclient.api.get_space(space_key)
+        webui = f"/spaces/{space_key}"
+        return Node(
+            f"space:{space_key}",
+            id=f"space:{space_key}",
+            title=space["name"],
+            modified=datetime.min,
+            version=None,
+            webui=webui,
+            link=f"{self.cclient.api.url}{webui}",
+            virtual=True,
+            space_name=space["name"],
+            ancestor_titles=[],
+        )
+
+    def _create_root_node(self, page):
         root_node = self._create_node(page)
-        self._recurse_build_tree(root_node)
-        for n in PreOrderIter(root_node):
-            n.link = f"{cclient.api.url}{n.webui}"
+        # Remember the context needed to export pages without querying each page's ancestors
+        root_node.space_name = page["space"]["name"]
+        root_node.ancestor_titles = [ap["title"] for ap in page["ancestors"]]
         return root_node
 
     def _create_node(self, page, parent_node: Node | None = None):
-        timestamp_str = page["history"]["lastUpdated"]["when"]
-        mod_timestamp = datetime.strptime(timestamp_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+        self.cclient.cache_page_body(page)
         return Node(
             page["id"],
             parent=parent_node,
             id=page["id"],
             title=page["title"],
-            modified=mod_timestamp,
+            modified=page_modified(page),
+            version=page["version"]["number"],
             webui=page["_links"]["webui"],
+            link=f"{self.cclient.api.url}{page['_links']['webui']}",
+            order=sibling_order(page),
+        )
+
+    def _recurse_build_tree(
+        self, parent_node, progress: "CrawlProgress", prefetch_bodies=False, depth=1
+    ):
+        child_nodes = []
+        # Add child pages to the tree as each batch of results is received
+        for p in self.cclient.iter_child_pages(parent_node.id, include_body=prefetch_bodies):
+            child_nodes.append(self._create_node(p, parent_node))
+            progress.pages_added(1)
+        for child in child_nodes:
+            self._recurse_build_tree(child, progress, prefetch_bodies, depth + 1)
+
+    def _build_tree_using_cql(
+        self, root_node, progress: "CrawlProgress", prefetch_bodies=False
+    ) -> bool:
+        try:
+            pages = self.cclient.iter_descendant_pages(root_node.id, include_body=prefetch_bodies)
+            self._add_descendant_pages(root_node, progress, pages)
+        except (HTTPError, ApiError) as e:
+            logger.warning("CQL search failed; falling back to querying child pages: %s", e)
+            root_node.children = []
+            progress.reset()
+            return False
+        return True
+
+    def _add_descendant_pages(
+        self,
+        root_node,
+        progress: "CrawlProgress",
+        pages: Iterable[dict],
+        on_node: Callable[[Node], None] | None = None,
+    ):
+        """
+        Adds pages (with their `ancestors`) to the tree as they are received.
+        Pages without ancestors (i.e., top-level pages in a space) are added to root_node.
+        Since search results are not in page order, each page's children are sorted by their
+        position at the end, so the tree matches one built from child page listings.
+        """
+        nodes = {root_node.id: root_node}
+        # Pages whose parent page has not been received yet, keyed by the parent's id
+        pending_pages: dict[str, list[dict]] = {}
+
+        def add_page(page, parent_node):
+            nodes[page["id"]] = self._create_node(page, parent_node)
+            progress.pages_added(1)
+            if on_node:
+                on_node(nodes[page["id"]])
+            for child_page in pending_pages.pop(page["id"], []):
+                add_page(child_page, nodes[page["id"]])
+
+        for page in pages:
+            parent_id = page["ancestors"][-1]["id"] if page["ancestors"] else root_node.id
+            if parent_id in nodes:
+                add_page(page, nodes[parent_id])
+            else:
+                pending_pages.setdefault(parent_id, []).append(page)
+
+        # Attach remaining pages to their closest ancestor in the tree,
+        # in case an ancestor page is not visible. Shallower pages are attached first.
+        remaining_pages = sorted(
+            (p for pages in pending_pages.values() for p in pages),
+            key=lambda p: len(p["ancestors"]),
+        )
+        for page in remaining_pages:
+            if page["id"] in nodes:
+                continue
+            parent_node = next(
+                (nodes[a["id"]] for a in reversed(page["ancestors"]) if a["id"] in nodes),
+                root_node,
+            )
+            add_page(page, parent_node)
+
+        for node in nodes.values():
+            if len(node.children) > 1:
+                node.children = sorted(node.children, key=lambda n: n.order)
+
+    def _build_tree_by_level(
+        self, root_node, progress: "CrawlProgress", prefetch_bodies, max_workers
+    ):
+        """
+        Breadth-first alternative to _recurse_build_tree() that queries the child pages
+        of all nodes in the same level using a bounded pool of worker threads.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="crawl") as executor:
+            level = [root_node]
+            depth = 1
+            while level:
+                logger.info("Querying child pages of %i pages at depth %i", len(level), depth)
+                # executor.map() returns results in the order of the input,
+                # so nodes are created (and children ordered) the same as in _recurse_build_tree()
+                all_child_pages = executor.map(
+                    functools.partial(self.cclient.get_child_pages, include_body=prefetch_bodies),
+                    [n.id for n in level],
+                )
+                next_level = []
+                for parent_node, child_pages in zip(level, all_child_pages):
+                    next_level += [self._create_node(p, parent_node) for p in child_pages]
+                    progress.pages_added(len(child_pages))
+                level = next_level
+                depth += 1
+
+    async def _async_query_pages_as_tree(
+        self, space_key, page_title, use_cql, prefetch_bodies, on_progress
+    ):
+        import httpx
+
+        async with self._create_async_client() as aclient:
+            page_id = await aclient.get_page_id(space_key, page_title)
+            page = await aclient.get_page_by_id(page_id, expand=ROOT_PAGE_EXPAND)
+            root_node = self._create_root_node(page)
+            progress = CrawlProgress(root_node, on_progress)
+            if use_cql:
+                try:
+                    pages = await aclient.get_descendant_pages(
+                        root_node.id, include_body=prefetch_bodies
+                    )
+                    self._add_descendant_pages(root_node, progress, pages)
+                    logger.info("Built tree using CQL search")
+                    return root_node
+                except httpx.HTTPStatusError as e:
+                    logger.warning("CQL search failed; falling back to querying child pages: %s", e)
+
+            level = [root_node]
+            while level:
+                # The number of concurrent requests is limited by the client's connection pool
+                all_child_pages = await asyncio.gather(
+                    *(aclient.get_child_pages(n.id, include_body=prefetch_bodies) for n in level)
+                )
+                next_level = []
+                for parent_node, child_pages in zip(level, all_child_pages):
+                    next_level += [self._create_node(p, parent_node) for p in child_pages]
+                    progress.pages_added(len(child_pages))
+                level = next_level
+        return root_node
+
+    def export_html_folder(
+        self,
+        tree: PageTree,
+        folder: str,
+        queue: Queue,
+        *,
+        reuse_crawl: bool = True,
+        max_workers: int = EXPORT_MAX_WORKERS,
+        incremental: bool = False,
+        attachments: bool = False,
+    ):
+        """
+        Exports pages with to_export set to HTML files in folders that mirror the page hierarchy.
+        If reuse_crawl, folder paths are derived from the tree built by query_pages_as_tree() and
+        cached page bodies are reused, so each page costs at most one request; if the tree is
+        older than EXPORT_VERSION_MAX_AGE, the pages' versions are checked first (see
+        _check_versions()).
+        Pages are exported concurrently if max_workers > 1.
+        Exported files are recorded in a manifest in the folder; if incremental, pages with the
+        same version as recorded in the manifest are skipped.
+        If attachments, images and attachments hosted by Confluence are downloaded into
+        an AttachmentStore in the folder and the pages link to the downloaded files.
+        Otherwise (if not reuse_crawl), each page (including its space and ancestors) is queried.
+        With the "async" backend, pages are fetched concurrently on an event loop instead.
+        """
+        os.makedirs(folder, exist_ok=True)
+        if reuse_crawl:
+            self._check_versions(tree)
+        if reuse_crawl and self.backend == "async":
+            asyncio.run(
+                self._async_export_pages_html(tree, folder, queue, incremental, attachments)
+            )
+        elif reuse_crawl:
+            self._export_pages_html(tree, folder, queue, max_workers, incremental, attachments)
+        else:
+            self._export_pages_by_id(tree, folder, queue)
+
+    def _check_versions(self, tree: PageTree):
+        """
+        Updates the versions of the pages to export in the tree if it was queried more than
+        EXPORT_VERSION_MAX_AGE seconds ago, so that pages edited since then are not exported
+        (or skipped as unchanged) using their cached bodies.
+        Takes one request per CQL_IDS_PER_QUERY pages.
+        """
+        if time.time() - tree.crawled_at <= EXPORT_VERSION_MAX_AGE:
+            return
+        page_ids = [p.id for p in tree.pages_to_export()]
+        versions = dict(
+            version
+            for start in range(0, len(page_ids), CQL_IDS_PER_QUERY)
+            for version in self.cclient.iter_cql_versions(
+                f"id in ({','.join(page_ids[start : start + CQL_IDS_PER_QUERY])})"
+            )
         )
+        changed_count = sum(v != tree.versions[tree.index(i)] for i, v in versions.items())
+        logger.info("%i of %i pages to export have new versions", changed_count, len(page_ids))
+        tree.set_versions(versions)
+
+    def _plan_export(self, tree: PageTree, folder, create_folders: bool = True):
+        """
+        Creates the folders for the pages to be exported, and returns the pages to be exported
+        in tree order, each page's filename, and the pages grouped by filename.
+        """
+        pages = tree.pages_to_export()
+        page_folders = {p.id: tree.folder(p.index, folder) for p in pages}
+        if create_folders:
+            # Create all folders up front and in order, so that workers only write files
+            for f in sorted(set(page_folders.values())):
+                os.makedirs(f, exist_ok=True)
 
-    def _recurse_build_tree(self, parent_node, depth=1):
-        child_pages = self.cclient.get_child_pages(parent_node.id)
-        child_nodes = [self._create_node(p, parent_node) for p in child_pages]
-        if child_pages:
-            for child in child_nodes:
-                self._recurse_build_tree(child, depth + 1)
+        # Pages that map to the same file are exported by the same task in tree order,
+        # so the last page wins like in _export_pages_by_id()
+        page_filenames = {p.id: page_html_filename(page_folders[p.id], p.title) for p in pages}
+        pages_by_filename: dict[str, list[Page]] = {}
+        for p in pages:
+            pages_by_filename.setdefault(page_filenames[p.id], []).append(p)
+        return pages, page_filenames, pages_by_filename
 
-    def export_html_folder(self, root_node: Node, folder: str, queue: Queue):
+    def export_space_html_folder(
+        self,
+        space_key: str,
+        folder: str,
+        queue: Queue,
+        *,
+        max_workers: int = EXPORT_MAX_WORKERS,
+        incremental: bool = False,
+    ) -> PageTree:
+        """
+        Exports every page in the space without waiting for the whole space to be listed:
+        each page is handed to the export workers as soon as _query_space_as_node_tree() adds
+        it to the tree, and its body comes with the listing. Returns the tree.
+        Unlike export_html_folder(), if pages map to the same file, which one wins is undefined.
+        """
         os.makedirs(folder, exist_ok=True)
-        self._recurse_export_html(root_node, folder, queue)
+        manifest = ExportManifest(folder)
+        # Exported pages and their futures, in the order that they were listed
+        pending: deque[tuple[Node, str, Future]] = deque()
+        counts = Counter()
+
+        def export_node(n: Node, filename: str) -> str:
+            if incremental and manifest.is_unchanged(n, filename):
+                return SKIPPED
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            logger.info("Exporting page %r", n.title)
+            _filename, written = self._export_page_html(n, node_folder(n, folder))
+            manifest.record(n, filename)
+            return WRITTEN if written else UNCHANGED
+
+        def report_exported(wait: bool):
+            while pending and (wait or pending[0][2].done()):
+                n, filename, future = pending.popleft()
+                counts[report_export(queue, n, filename, future.result())] += 1
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        try:
+
+            def on_node(n: Node):
+                filename = page_html_filename(node_folder(n, folder), n.title)
+                pending.append((n, filename, executor.submit(export_node, n, filename)))
+                report_exported(wait=False)
+
+            root_node = self._query_space_as_node_tree(
+                space_key, prefetch_bodies=True, on_node=on_node
+            )
+            report_exported(wait=True)
+            report_export_counts(queue, counts)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            manifest.save()
+        return PageTree.from_node(root_node, self.cclient.api.url)
+
+    def _create_attachment_store(self, folder: str) -> AttachmentStore:
+        return AttachmentStore(folder, self.cclient.api.url, self.cclient.open_download)
+
+    def _export_pages_html(
+        self, tree: PageTree, folder, queue: Queue, max_workers, incremental, attachments
+    ):
+        pages, page_filenames, pages_by_filename = self._plan_export(tree, folder)
+        manifest = ExportManifest(folder)
+        attachment_store = self._create_attachment_store(folder) if attachments else None
+
+        def export_pages(filename: str, same_file_pages: list[Page]) -> str:
+            # The file's content comes from the last page, so skip if that page is unchanged
+            if incremental and manifest.is_unchanged(same_file_pages[-1], filename):
+                return SKIPPED
+            written = False
+            for p in same_file_pages:
+                logger.info("Exporting page %r", p.title)
+                written |= self._export_page_html(p, os.path.dirname(filename), attachment_store)[1]
+            manifest.record(same_file_pages[-1], filename)
+            return WRITTEN if written else UNCHANGED
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        try:
+            futures = {
+                filename: executor.submit(export_pages, filename, same_file_pages)
+                for filename, same_file_pages in pages_by_filename.items()
+            }
+            # Report progress in tree order
+            counts = Counter()
+            for p in pages:
+                filename = page_filenames[p.id]
+                counts[report_export(queue, p, filename, futures[filename].result())] += 1
+            report_export_counts(queue, counts)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            manifest.save()
+            if attachment_store:
+                attachment_store.close()
+
+    async def _async_export_pages_html(
+        self, tree: PageTree, folder, queue: Queue, incremental, attachments
+    ):
+        pages, page_filenames, pages_by_filename = self._plan_export(tree, folder)
+        manifest = ExportManifest(folder)
+        attachment_store = self._create_attachment_store(folder) if attachments else None
+
+        async with self._create_async_client() as aclient:
+
+            async def export_pages(filename: str, same_file_pages: list[Page]) -> str:
+                if incremental and manifest.is_unchanged(same_file_pages[-1], filename):
+                    return SKIPPED
+                written = False
+                page_folder = os.path.dirname(filename)
+                for p in same_file_pages:
+                    logger.info("Exporting page %r", p.title)
+                    html_value = await aclient.get_page_html(p.id, p.version)
+                    rewrite_url = None
+                    if attachment_store:
+                        # Downloads attachments on the store's threads
+                        rewrite_url = await asyncio.to_thread(
+                            attachment_store.localize, html_value, page_folder
+                        )
+                    # Parsing and writing the file would otherwise block the event loop
+                    _filename, page_written = await asyncio.to_thread(
+                        save_page_html, p.title, p.link, html_value, page_folder, rewrite_url
+                    )
+                    written |= page_written
+                await asyncio.to_thread(manifest.record, same_file_pages[-1], filename)
+                return WRITTEN if written else UNCHANGED
+
+            # Files are exported by at most ASYNC_MAX_CONNECTIONS tasks at a time, each starting
+            # the next file's task when it is done, rather than by a task per file up front
+            unstarted = iter(pages_by_filename.items())
+            tasks: dict[str, asyncio.Task] = {}
+
+            def start_task(_done_task=None):
+                if (item := next(unstarted, None)) is not None:
+                    tasks[item[0]] = task = asyncio.create_task(export_pages(*item))
+                    task.add_done_callback(start_task)
+
+            for _ in range(ASYNC_MAX_CONNECTIONS):
+                start_task()
+            try:
+                counts = Counter()
+                for p in pages:
+                    filename = page_filenames[p.id]
+                    counts[report_export(queue, p, filename, await tasks[filename])] += 1
+                report_export_counts(queue, counts)
+            finally:
+                unstarted = iter(())
+                for task in tasks.values():
+                    task.cancel()
+                manifest.save()
+                if attachment_store:
+                    attachment_store.close()
+
+    def export_html_archive(
+        self,
+        tree: PageTree,
+        archive_path: str,
+        queue: Queue,
+        *,
+        max_workers: int = EXPORT_MAX_WORKERS,
+    ):
+        """
+        Like export_html_folder() but streams the pages into a zip or tar archive (depending on
+        archive_path's suffix), using the folder structure as paths within the archive.
+        The archive is rewritten on every export, so incremental export is not supported.
+        """
+        self._check_versions(tree)
+        pages, page_filenames, pages_by_filename = self._plan_export(tree, "", create_folders=False)
+
+        def export_page(filename: str, page: Page) -> str:
+            logger.info("Exporting page %r", page.title)
+            html_value = self.cclient.get_page_html(page.id, page.version)
+            archive.write(
+                filename,
+                lambda f: write_page_html(HashingWriter(f), page.title, page.link, html_value),
+            )
+            return WRITTEN
+
+        with (
+            ArchiveWriter(archive_path) as archive,
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export") as executor,
+        ):
+            try:
+                # The file's content comes from the last page, so only that page is written
+                futures = {
+                    filename: executor.submit(export_page, filename, same_file_pages[-1])
+                    for filename, same_file_pages in pages_by_filename.items()
+                }
+                counts = Counter()
+                for p in pages:
+                    filename = page_filenames[p.id]
+                    counts[report_export(queue, p, filename, futures[filename].result())] += 1
+                report_export_counts(queue, counts)
+            finally:
+                executor.shutdown(cancel_futures=True)
+        queue.put(f"Saved archive `{archive_path}`")
+
+    def _export_pages_by_id(self, tree: PageTree, folder, queue: Queue):
+        "Exports each page by its id, which looks up the page's ancestors for its folder"
+        for page in tree.pages_to_export():
+            logger.info("Exporting page %r", page.title)
+            filename, written = self.cclient.export_page_html(
+                page.id, folder, create_ancestor_folders=True
+            )
+            report_export(queue, page, filename, WRITTEN if written else UNCHANGED)
+
+    def _export_page_html(
+        self, page: Page | Node, page_folder: str, attachment_store: AttachmentStore | None = None
+    ):
+        html_value = self.cclient.get_page_html(page.id, page.version)
+        rewrite_url = (
+            attachment_store.localize(html_value, page_folder) if attachment_store else None
+        )
+        return self.cclient.save_page_html(
+            page.title, page.link, html_value, page_folder, rewrite_url
+        )
+
+
+def lastmodified_cql(since: datetime) -> str:
+    return f'lastmodified >= "{since:%Y-%m-%d %H:%M}"'
 
-    def _recurse_export_html(self, node: Node, folder, queue: Queue, depth=1):
-        if node.to_export:
-            logger.info("Exporting page %r", node.title)
-            filename = self.cclient.export_page_html(node.id, folder, create_ancestor_folders=True)
-            queue.put(f"Saved page `{node.title}` to `{filename}`")
 
-        for child in node.children or []:
-            self._recurse_export_html(child, folder, queue, depth + 1)
+def tree_scope_cql(tree: PageTree, i: int, space_key: str, filtered: bool = True) -> str:
+    """
+    Returns the CQL query for the descendants of page i in Confluence, which are limited to
+    the pages modified after the tree's modified_after if filtered
+    """
+    if i == 0 and tree.virtual_root:
+        cql = f'space = "{space_key}" and type = page'
+    else:
+        cql = f"ancestor = {tree.ids[i]} and type = page"
+    if filtered and tree.modified_after is not None:
+        cql = f"{cql} and {lastmodified_cql(from_timestamp(tree.modified_after))}"
+    return cql
+
+
+def page_modified(page: dict) -> datetime:
+    return datetime.strptime(page["history"]["lastUpdated"]["when"], "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def sibling_order(page: dict) -> tuple:
+    "Orders pages like Confluence orders siblings: by position, then pages without one by title"
+    position = page.get("extensions", {}).get("position")
+    if isinstance(position, int) and position >= 0:
+        return (0, position, "")
+    return (1, 0, page["title"])
+
+
+def page_row(page: dict) -> tuple[str, list[str], str, datetime, int, str]:
+    "Returns the page's fields for PageTree.update()"
+    ancestor_ids = [a["id"] for a in page["ancestors"]]
+    return (
+        page["id"],
+        ancestor_ids,
+        page["title"],
+        page_modified(page),
+        page["version"]["number"],
+        page["_links"]["webui"],
+    )
+
+
+def ancestor_stub_rows(page: dict, root_id: str) -> list[tuple]:
+    "Returns rows for PageTree.update() for the page's ancestors under the root as stubs"
+    if page["id"] == root_id:
+        return []
+    ancestor_ids = [a["id"] for a in page["ancestors"]]
+    # Skip the root and the pages above it
+    start = ancestor_ids.index(root_id) + 1 if root_id in ancestor_ids else 0
+    return [
+        (a["id"], ancestor_ids[:k], a["title"], EPOCH, 0, a.get("_links", {}).get("webui", ""))
+        for k, a in enumerate(page["ancestors"])
+        if k >= start
+    ]
+
+
+# Outcomes of exporting a page
+WRITTEN = "written"
+# The page was exported but the file's content did not change, so the file was not rewritten
+UNCHANGED = "unchanged"
+# The page's version is the same as recorded in the export manifest, so it was not exported
+SKIPPED = "skipped"
+
+
+def report_export(queue: Queue, page: Page | Node, filename: str, status: str) -> str:
+    if status == WRITTEN:
+        queue.put(f"Saved page `{page.title}` to `{filename}`")
+    elif status == UNCHANGED:
+        queue.put(f"Page `{page.title}` is identical to `{filename}`")
+    else:
+        queue.put(f"Skipped unchanged page `{page.title}` in `{filename}`")
+    return status
+
+
+def report_export_counts(queue: Queue, counts: Counter):
+    queue.put(
+        f"Exported {counts.total()} pages: {counts[WRITTEN]} written,"
+        f" {counts[UNCHANGED]} unchanged, {counts[SKIPPED]} skipped"
+    )
+
+
+def is_virtual(node: Node) -> bool:
+    "Returns True for the root node of a whole space, which is not a page"
+    return getattr(node, "virtual", False)
+
+
+def node_folder(node: Node, export_folder: str) -> str:
+    "Returns the folder for the node's HTML file, mirroring ConfluenceClient.export_page_html()"
+    root_node = node.root
+    parent_nodes = node.path[1:-1] if is_virtual(root_node) else node.path[:-1]
+    parent_folders = [*root_node.ancestor_titles, *(n.title for n in parent_nodes)]
+    return os.path.join(export_folder, root_node.space_name, *parent_folders)
 
 
 def is_google_folder(gfile: dict) -> bool:
     return gfile["mimeType"] == "application/vnd.google-apps.folder"
 
 
-def gfile_exists_locally(gfile: dict, local_folder: str, file_suffix: str = ".html") -> bool:
+def gfile_exists_locally(
+    gfile: dict, local_folder: str, file_suffix: str = ".html", source=LocalFolder()
+) -> bool:
     if is_google_folder(gfile):
         full_path = os.path.join(local_folder, gfile["name"])
-        return os.path.isdir(full_path)
+        return source.isdir(full_path)
 
     filename = f"{gfile['name']}{file_suffix}"
     full_path = os.path.join(local_folder, filename)
-    return os.path.isfile(full_path)
+    return source.isfile(full_path)
 
 
 def sync_folder_to_gdrive(
@@ -126,85 +945,120 @@ def sync_folder_to_gdrive(
     skip_existing=True,
     delete_gfiles=False,
     dry_run=False,
+    source=LocalFolder(),
+    max_workers: int = GDRIVE_UPLOAD_WORKERS,
 ):
-    existing_gfiles = gclient.files_in_folder(folder_id)
+    """
+    Uploads the files in input_folder to the GDrive folder, recursing into subfolders.
+    The GDrive folder tree is indexed up front, so existing files are not listed per folder.
+    Missing folders are created level by level and unmatched files deleted in batches.
+    Files are uploaded by up to max_workers threads; progress is reported in the same order
+    as when uploading one file at a time.
+    To upload from an export archive, pass source=ExportArchive(path) and input_folder="".
+    """
+    queue.put("Listing existing files in GDrive ...")
+    index = gclient.index_folder_tree(folder_id)
 
-    if delete_gfiles:
-        # Delete GDrive files that no longer exist locally
-        for gfile in existing_gfiles:
-            if gfile["name"].startswith("."):
-                logger.info("Skipping hidden file %r", gfile["name"])
-                continue
-            if is_google_folder(gfile):
-                continue
-            logger.info("Checking %r", gfile)
-            if not gfile_exists_locally(gfile, input_folder):
-                if not dry_run:
-                    logger.info("Deleting %r from GDrive %r", gfile["name"], input_folder)
-                    gclient.delete_file(gfile["id"])
-                queue.put(f"Delete `{gfile['name']}` from GDrive `{input_folder}`")
+    # GDrive folder path -> local folder
+    local_folders = {"": input_folder}
+    gfiles_to_delete = []
+    # (html_filename, GDrive folder path, title)
+    files_to_upload = []
+    level = [""]
+    while level:
+        next_level = []
+        # (GDrive folder path, folder name) of folders to create
+        missing_folders = []
+        for gdrive_path in level:
+            local_folder = local_folders[gdrive_path]
+            if delete_gfiles:
+                # Delete GDrive files that no longer exist locally
+                for gfile in index.files_in(gdrive_path):
+                    if gfile["name"].startswith("."):
+                        logger.info("Skipping hidden file %r", gfile["name"])
+                        continue
+                    if is_google_folder(gfile):
+                        continue
+                    logger.info("Checking %r", gfile)
+                    if not gfile_exists_locally(gfile, local_folder, source=source):
+                        gfiles_to_delete.append((gfile, local_folder))
 
-    # Upload to GDrive, updating if file with same name exists
-    existing_gfilenames = {
-        f["name"]: f
-        for f in existing_gfiles
-        if f["mimeType"] != "application/vnd.google-apps.folder"
-    }
-    existing_gfolders = {
-        f["name"]: f
-        for f in existing_gfiles
-        if f["mimeType"] == "application/vnd.google-apps.folder"
-    }
-    # logger.info("Existing gfiles: %r", existing_gfilenames)
-    # logger.info("Existing gfolders: %r", existing_gfolders)
-
-    export_files = os.listdir(input_folder)
-    # logger.info("Files in folder: %r", export_files)
-    for e_file in export_files:
-        # Check if e_file is a folder
-        subfolder_path = os.path.join(input_folder, e_file)
-        if os.path.isdir(subfolder_path):
-            if e_file not in existing_gfolders:
-                subfolder = gclient.create_drive_folder(e_file, folder_id)
-                subfolder_id = subfolder["id"]
+            for e_file in source.listdir(local_folder):
+                if e_file.startswith("."):
+                    # E.g., the export manifest
+                    continue
+                path = os.path.join(local_folder, e_file)
+                if source.isdir(path):
+                    gdrive_subfolder = posixpath.join(gdrive_path, e_file)
+                    local_folders[gdrive_subfolder] = path
+                    next_level.append(gdrive_subfolder)
+                    if index.folder_id(gdrive_subfolder) is None:
+                        missing_folders.append((gdrive_path, e_file))
+                else:
+                    files_to_upload.append((path, gdrive_path, e_file.removesuffix(".html")))
+
+        # The next level's folders need the IDs of the folders created at this level
+        results = gclient.create_drive_folders(
+            [(name, index.folder_id(gdrive_path)) for gdrive_path, name in missing_folders]
+        )
+        for (gdrive_path, name), (gfolder, error) in zip(missing_folders, results):
+            if error:
+                logger.warning("Error creating GDrive folder %r: %s", name, error)
+                queue.put(f"Failed to create GDrive folder `{name}` in `{gdrive_path}`: {error}")
+                next_level.remove(posixpath.join(gdrive_path, name))
             else:
-                subfolder_id = existing_gfolders[e_file]["id"]
-            logger.info("Recurse into folder %r", e_file)
-            sync_folder_to_gdrive(
-                gclient,
-                subfolder_path,
-                subfolder_id,
-                queue,
-                skip_existing=skip_existing,
-                delete_gfiles=delete_gfiles,
-                dry_run=dry_run,
-            )
-            continue
-
-        html_filename = os.path.join(input_folder, e_file)
-        title = e_file.removesuffix(".html")
-        # logger.info("title %r", title)
-        # TODO: check timestamps to determine if update/upload is needed
-        if title in existing_gfilenames:
-            if skip_existing:
-                logger.info("  Skipping existing %r in GDrive", title)
-                queue.put(
-                    f"Skipping existing `{title}` in GDrive [{folder_id}](https://drive.google.com/drive/folders/{folder_id})"
-                )
+                index.add(gdrive_path, gfolder)
+        level = next_level
+
+    if gfiles_to_delete:
+        if dry_run:
+            deleted = [True] * len(gfiles_to_delete)
+        else:
+            logger.info("Deleting %i files from GDrive", len(gfiles_to_delete))
+            deleted = gclient.delete_files([gfile["id"] for gfile, _ in gfiles_to_delete])
+        for (gfile, local_folder), is_deleted in zip(gfiles_to_delete, deleted):
+            if is_deleted:
+                queue.put(f"Delete `{gfile['name']}` from GDrive `{local_folder}`")
+            else:
+                queue.put(f"Failed to delete `{gfile['name']}` from GDrive `{local_folder}`")
+
+    # Upload to GDrive, updating if file with same name exists
+    def upload_file(html_filename, folder_id, title, file_id=None):
+        logger.info("  %s %r in GDrive", "Updating" if file_id else "Uploading", title)
+        gclient.upload_to_google_drive(html_filename, folder_id, title, file_id, source=source)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+    try:
+        # (message, future) of each file, reported in the order that they were planned
+        uploads: list[tuple[str, Future | None]] = []
+        existing_gfilenames = {}
+        for html_filename, gdrive_path, title in files_to_upload:
+            if gdrive_path not in existing_gfilenames:
+                existing_gfilenames[gdrive_path] = index.files_by_name(gdrive_path)
+            folder_id = index.folder_id(gdrive_path)
+            folder_link = f"[{folder_id}](https://drive.google.com/drive/folders/{folder_id})"
+            future = None
+            # TODO: check timestamps to determine if update/upload is needed
+            if title in existing_gfilenames[gdrive_path]:
+                if skip_existing:
+                    logger.info("  Skipping existing %r in GDrive", title)
+                    message = f"Skipping existing `{title}` in GDrive {folder_link}"
+                else:
+                    file_id = existing_gfilenames[gdrive_path][title]["id"]
+                    if not dry_run:
+                        future = executor.submit(
+                            upload_file, html_filename, folder_id, title, file_id
+                        )
+                    message = f"Update `{title}` in GDrive {folder_link}"
             else:
-                file_id = existing_gfilenames[title]["id"]
                 if not dry_run:
-                    logger.info("  Updating %r in GDrive", title)
-                    response = gclient.upload_to_google_drive(
-                        html_filename, folder_id, title, file_id
-                    )
-                queue.put(
-                    f"Update `{title}` in GDrive [{folder_id}](https://drive.google.com/drive/folders/{folder_id})"
-                )
-        else:
-            if not dry_run:
-                logger.info("  Uploading %r", title)
-                response = gclient.upload_to_google_drive(html_filename, folder_id, title)
-            queue.put(
-                f"Upload `{title}` in GDrive [{folder_id}](https://drive.google.com/drive/folders/{folder_id})"
-            )
+                    future = executor.submit(upload_file, html_filename, folder_id, title)
+                message = f"Upload `{title}` in GDrive {folder_link}"
+            uploads.append((message, future))
+
+        for message, future in uploads:
+            if future:
+                future.result()
+            queue.put(message)
+    finally:
+        executor.shutdown(cancel_futures=True)
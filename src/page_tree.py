@@ -0,0 +1,456 @@
+import copy
+import itertools
+import os
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+from anytree import Node, PreOrderIter
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(dt: datetime) -> float:
+    "For the naive UTC datetimes of page modification times"
+    return (dt - EPOCH).total_seconds()
+
+
+def from_timestamp(timestamp: float) -> datetime:
+    return EPOCH + timedelta(seconds=timestamp)
+
+
+class Page:
+    "A page in a PageTree, with the fields needed to report and export it"
+
+    __slots__ = ("index", "id", "title", "modified", "version", "link")
+
+    def __init__(self, index, id, title, modified, version, link):
+        self.index = index
+        self.id = id
+        self.title = title
+        self.modified = modified
+        self.version = version
+        self.link = link
+
+    def __repr__(self):
+        return f"Page({self.id!r}, {self.title!r})"
+
+
+class PageTree:
+    """
+    Compact page hierarchy for large trees. Pages are stored in pre-order in column arrays,
+    so page 0 is the root and the subtree of page i is pages i to subtree_ends[i] - 1.
+    by_modified lists the pages in order of modification time, so that pages modified since
+    a given time can be found with a binary search.
+    `include` and `to_export` are flags per page, whose counts are kept up to date
+    so that they can be read in O(1).
+    include_version and to_export_version are incremented whenever the flags change,
+    so that views of the tree can be cached until they do.
+    crawled_at is the time.time() when the pages were queried from Confluence.
+    If modified_after is set, only the pages modified since then were queried, along with
+    their ancestors as stubs whose other descendants are not in the tree; stale_counts holds
+    the number of those descendants once they have been counted.
+    If the root is virtual (i.e., a whole space rather than a page), it is never exported.
+    """
+
+    __slots__ = (
+        "ids",
+        "titles",
+        "modified",
+        "versions",
+        "webuis",
+        "parents",
+        "subtree_ends",
+        "by_modified",
+        "sorted_modified",
+        "index_by_id",
+        "include",
+        "to_export",
+        "include_count",
+        "to_export_count",
+        "include_version",
+        "to_export_version",
+        "base_url",
+        "space_name",
+        "ancestor_titles",
+        "virtual_root",
+        "crawled_at",
+        "modified_after",
+        "stub_ids",
+        "stale_counts",
+    )
+
+    def __init__(
+        self,
+        pages: Iterable[tuple[str, int, str, datetime, int | None, str]],
+        *,
+        base_url: str,
+        space_name: str,
+        ancestor_titles: list[str],
+        virtual_root: bool = False,
+        crawled_at: float | None = None,
+        modified_after: float | None = None,
+        stub_ids: Iterable[str] = (),
+    ):
+        """
+        pages are (id, parent_index, title, modified, version, webui) in pre-order,
+        where parent_index is -1 for the root
+        """
+        self._set_pages(
+            (page_id, parent_index, title, to_timestamp(modified), version, webui)
+            for page_id, parent_index, title, modified, version, webui in pages
+        )
+        self.include_version = 0
+        self.to_export_version = 0
+        self.base_url = base_url
+        self.space_name = space_name
+        self.ancestor_titles = ancestor_titles
+        self.virtual_root = virtual_root
+        self.crawled_at = time.time() if crawled_at is None else crawled_at
+        self.modified_after = modified_after
+        self.stub_ids = set(stub_ids)
+        self.stale_counts: dict[str, int] = {}
+        if modified_after is not None:
+            # Stubs (and the root, if it is older) are not selected
+            self.include_modified_since(from_timestamp(modified_after))
+            self.to_export = bytearray(self.include)
+            self.to_export_count = self.include_count
+
+    def _set_pages(self, pages: Iterable[tuple[str, int, str, float, int | None, str]]):
+        "Like __init__() but with modification times as timestamps; every page is selected"
+        self.ids: list[str] = []
+        self.titles: list[str] = []
+        self.modified = array("d")
+        self.versions = array("q")
+        self.webuis: list[str] = []
+        self.parents = array("l")
+        for page_id, parent_index, title, modified, version, webui in pages:
+            self.ids.append(page_id)
+            self.parents.append(parent_index)
+            self.titles.append(title)
+            self.modified.append(modified)
+            # The virtual root has no version
+            self.versions.append(version or 0)
+            self.webuis.append(webui)
+        self.index_by_id = {page_id: i for i, page_id in enumerate(self.ids)}
+
+        # Compute where each subtree ends by walking back up from each page
+        count = len(self.ids)
+        self.subtree_ends = array("l", range(1, count + 1))
+        for i in range(count - 1, 0, -1):
+            parent = self.parents[i]
+            self.subtree_ends[parent] = max(self.subtree_ends[parent], self.subtree_ends[i])
+
+        self.by_modified = array("l", sorted(range(count), key=self.modified.__getitem__))
+        self.sorted_modified = array("d", (self.modified[i] for i in self.by_modified))
+
+        self.include = bytearray(b"\x01" * count)
+        self.to_export = bytearray(b"\x01" * count)
+        self.include_count = count
+        self.to_export_count = count
+
+    @classmethod
+    def from_node(
+        cls,
+        root_node: Node,
+        base_url: str,
+        crawled_at: float | None = None,
+        modified_after: datetime | None = None,
+    ) -> "PageTree":
+        "Converts an anytree built by ConfluenceOps, whose root has space_name and ancestor_titles"
+        index_by_node = {}
+
+        def pages():
+            for i, n in enumerate(PreOrderIter(root_node)):
+                index_by_node[n] = i
+                parent_index = index_by_node[n.parent] if n.parent else -1
+                yield n.id, parent_index, n.title, n.modified, n.version, n.webui
+
+        return cls(
+            pages(),
+            base_url=base_url,
+            space_name=root_node.space_name,
+            ancestor_titles=root_node.ancestor_titles,
+            virtual_root=getattr(root_node, "virtual", False),
+            crawled_at=crawled_at,
+            modified_after=to_timestamp(modified_after) if modified_after else None,
+        )
+
+    def to_dict(self) -> dict:
+        "Returns the pages as JSON-serializable columns, without the selections"
+        return {
+            "ids": self.ids,
+            "parents": self.parents.tolist(),
+            "titles": self.titles,
+            "modified": self.modified.tolist(),
+            "versions": self.versions.tolist(),
+            "webuis": self.webuis,
+            "base_url": self.base_url,
+            "space_name": self.space_name,
+            "ancestor_titles": self.ancestor_titles,
+            "virtual_root": self.virtual_root,
+            "crawled_at": self.crawled_at,
+            "modified_after": self.modified_after,
+            "stub_ids": sorted(self.stub_ids),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PageTree":
+        pages = zip(
+            data["ids"],
+            data["parents"],
+            data["titles"],
+            map(from_timestamp, data["modified"]),
+            data["versions"],
+            data["webuis"],
+        )
+        return cls(
+            pages,
+            base_url=data["base_url"],
+            space_name=data["space_name"],
+            ancestor_titles=data["ancestor_titles"],
+            virtual_root=data["virtual_root"],
+            crawled_at=data["crawled_at"],
+            modified_after=data["modified_after"],
+            stub_ids=data["stub_ids"],
+        )
+
+    def update(
+        self,
+        changed_pages: Iterable[tuple[str, list[str], str, datetime, int, str]],
+        deleted_ids: Iterable[str] = (),
+        stub_pages: Iterable[tuple[str, list[str], str, datetime, int, str]] = (),
+    ):
+        """
+        Applies changes to the tree in place, keeping the selections of the existing pages.
+        changed_pages are (id, ancestor_ids, title, modified, version, webui) of new, modified
+        or moved pages; each page is put under its closest ancestor in the tree, or the root.
+        New pages are appended to their parent's children and are selected.
+        Like in Confluence, the children of a deleted page move up to the deleted page's parent.
+        stub_pages are in the same format and are added, unselected, if they are not in the tree.
+        """
+        root_id = self.ids[0]
+        rows = {
+            page_id: (self.titles[i], self.modified[i], self.versions[i], self.webuis[i])
+            for i, page_id in enumerate(self.ids)
+        }
+        flags = {
+            page_id: (self.include[i], self.to_export[i]) for i, page_id in enumerate(self.ids)
+        }
+        parent_ids = {self.ids[i]: self.ids[p] for i, p in enumerate(self.parents) if p >= 0}
+        child_ids = {
+            page_id: [self.ids[c] for c in self.children(i)] for i, page_id in enumerate(self.ids)
+        }
+
+        stub_ids = set(self.stub_ids)
+        for page_id in deleted_ids:
+            if page_id not in parent_ids:
+                continue
+            stub_ids.discard(page_id)
+            parent_id = parent_ids.pop(page_id)
+            siblings = child_ids[parent_id]
+            position = siblings.index(page_id)
+            orphan_ids = child_ids.pop(page_id)
+            siblings[position : position + 1] = orphan_ids
+            for child_id in orphan_ids:
+                parent_ids[child_id] = parent_id
+            del rows[page_id], flags[page_id]
+
+        changed_pages = list(changed_pages)
+        changed_ids = {p[0] for p in changed_pages}
+        # Ancestors are repeated for pages that share them
+        stub_pages = {
+            p[0]: p for p in stub_pages if p[0] not in rows and p[0] not in changed_ids
+        }.values()
+        for page_id, _ancestor_ids, title, modified, version, webui in stub_pages:
+            rows[page_id] = (title, to_timestamp(modified), version, webui)
+            flags[page_id] = (0, 0)
+            child_ids[page_id] = []
+            stub_ids.add(page_id)
+        for page_id, _ancestor_ids, title, modified, version, webui in changed_pages:
+            rows[page_id] = (title, to_timestamp(modified), version, webui)
+            if page_id not in flags or page_id in stub_ids:
+                flags[page_id] = (1, 1)
+            child_ids.setdefault(page_id, [])
+            stub_ids.discard(page_id)
+        for page_id, ancestor_ids, *_ in [*stub_pages, *changed_pages]:
+            if page_id == root_id:
+                continue
+            parent_id = next((a for a in reversed(ancestor_ids) if a in rows), root_id)
+            if parent_id != parent_ids.get(page_id):
+                if page_id in parent_ids:
+                    child_ids[parent_ids[page_id]].remove(page_id)
+                child_ids[parent_id].append(page_id)
+                parent_ids[page_id] = parent_id
+
+        if stub_ids:
+            # Drop stubs that no longer have pages under them, e.g., after those were deleted
+            order = []
+            stack = [root_id]
+            while stack:
+                order.append(page_id := stack.pop())
+                stack.extend(child_ids[page_id])
+            needed_ids = set()
+            for page_id in reversed(order):
+                if page_id not in stub_ids or any(c in needed_ids for c in child_ids[page_id]):
+                    needed_ids.add(page_id)
+            for page_id in needed_ids:
+                child_ids[page_id] = [c for c in child_ids[page_id] if c in needed_ids]
+            stub_ids &= needed_ids
+
+        def pages():
+            # Depth-first so that pages are in pre-order
+            stack = [(root_id, -1)]
+            index = 0
+            while stack:
+                page_id, parent_index = stack.pop()
+                yield page_id, parent_index, *rows[page_id]
+                stack.extend((child_id, index) for child_id in reversed(child_ids[page_id]))
+                index += 1
+
+        self._set_pages(pages())
+        self.stub_ids = stub_ids
+        self.stale_counts = {}
+        for i, page_id in enumerate(self.ids):
+            self.include[i], self.to_export[i] = flags[page_id]
+        self.include_count = self.include.count(1)
+        self.to_export_count = self.to_export.count(1)
+        self.include_version += 1
+        self.to_export_version += 1
+
+    def copy(self) -> "PageTree":
+        "Copies the selections and stubs, sharing the page columns, which update() replaces"
+        tree = copy.copy(self)
+        tree.include = bytearray(self.include)
+        tree.to_export = bytearray(self.to_export)
+        tree.stub_ids = set(self.stub_ids)
+        tree.stale_counts = dict(self.stale_counts)
+        return tree
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def root_title(self) -> str:
+        return self.titles[0]
+
+    @property
+    def page_count(self) -> int:
+        "Number of pages, excluding a virtual root"
+        return len(self.ids) - 1 if self.virtual_root else len(self.ids)
+
+    @property
+    def excluded_count(self) -> int:
+        return len(self.ids) - self.include_count
+
+    def index(self, page_id: str) -> int:
+        return self.index_by_id[page_id]
+
+    def is_stub(self, i: int) -> bool:
+        return self.ids[i] in self.stub_ids
+
+    def loaded_descendant_count(self, i: int) -> int:
+        return self.subtree_ends[i] - i - 1
+
+    def is_exportable(self, i: int) -> bool:
+        return not (i == 0 and self.virtual_root)
+
+    def modified_at(self, i: int) -> datetime:
+        return from_timestamp(self.modified[i])
+
+    def link(self, i: int) -> str:
+        return f"{self.base_url}{self.webuis[i]}"
+
+    def page(self, i: int) -> Page:
+        # Stubs have no version, so their bodies are not looked up in the cache by version
+        version = self.versions[i] or None
+        return Page(i, self.ids[i], self.titles[i], self.modified_at(i), version, self.link(i))
+
+    def children(self, i: int) -> Iterator[int]:
+        child = i + 1
+        while child < self.subtree_ends[i]:
+            yield child
+            child = self.subtree_ends[child]
+
+    def has_children(self, i: int) -> bool:
+        return self.subtree_ends[i] > i + 1
+
+    def ancestors(self, i: int) -> list[int]:
+        "Returns the indexes of the page's ancestors, starting with the root"
+        ancestors = []
+        while (i := self.parents[i]) >= 0:
+            ancestors.append(i)
+        ancestors.reverse()
+        return ancestors
+
+    def folder(self, i: int, export_folder: str) -> str:
+        "Returns the folder for the page's HTML file, mirroring ConfluenceClient.export_page_html()"
+        ancestors = self.ancestors(i)
+        if self.virtual_root and ancestors:
+            ancestors = ancestors[1:]
+        parent_folders = [*self.ancestor_titles, *(self.titles[a] for a in ancestors)]
+        return os.path.join(export_folder, self.space_name, *parent_folders)
+
+    def set_include(self, i: int, value: bool):
+        if self.include[i] != value:
+            self.include[i] = value
+            self.include_count += 1 if value else -1
+            self.include_version += 1
+
+    def set_to_export(self, i: int, value: bool):
+        if self.to_export[i] != value:
+            self.to_export[i] = value
+            self.to_export_count += 1 if value else -1
+            self.to_export_version += 1
+
+    def _replace_include(self, include: bytearray, include_count: int):
+        if include != self.include:
+            self.include = include
+            self.include_count = include_count
+            self.include_version += 1
+
+    def _replace_to_export(self, to_export: bytearray, to_export_count: int):
+        if to_export != self.to_export:
+            self.to_export = to_export
+            self.to_export_count = to_export_count
+            self.to_export_version += 1
+
+    def include_modified_since(self, timestamp: datetime):
+        "Includes only the pages modified at or after timestamp"
+        start = bisect_left(self.sorted_modified, to_timestamp(timestamp))
+        include = bytearray(len(self.ids))
+        for i in self.by_modified[start:]:
+            include[i] = 1
+        self._replace_include(include, len(self.ids) - start)
+
+    def set_to_export_ids(self, page_ids: Iterable[str]):
+        "Sets to_export for the pages with the given ids and clears it for the others"
+        to_export = bytearray(len(self.ids))
+        for page_id in page_ids:
+            # Ignores ids that are not pages, e.g., tree_select's "children_" nodes
+            if (i := self.index_by_id.get(page_id)) is not None:
+                to_export[i] = 1
+        self._replace_to_export(to_export, to_export.count(1))
+
+    def include_to_export(self):
+        "Sets include to to_export for every page, e.g., so that a refresh retains selections"
+        self._replace_include(bytearray(self.to_export), self.to_export_count)
+
+    def set_versions(self, versions: dict[str, int]):
+        "Updates the versions of pages, e.g., with their current versions before an export"
+        for page_id, version in versions.items():
+            if (i := self.index_by_id.get(page_id)) is not None:
+                self.versions[i] = version
+
+    def ids_where(self, flags: bytearray) -> list[str]:
+        return list(itertools.compress(self.ids, flags))
+
+    def pages_to_export(self) -> list[Page]:
+        "Returns the pages with to_export set, in pre-order"
+        return [
+            self.page(i)
+            for i in range(len(self.ids))
+            if self.to_export[i] and self.is_exportable(i)
+        ]
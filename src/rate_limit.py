@@ -0,0 +1,299 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Throttled:
+    "Describes a rate-limited response"
+
+    status: int
+    retry_after: float | None = None
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    "Parses a Retry-After header, which is either a number of seconds or an HTTP date"
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    "Allows `rate` calls per second on average, with bursts of up to `capacity` calls"
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        "Takes a token and returns how many seconds to wait before it can be used"
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    Coordinates all calls to a service across threads (and event loops):
+    - a token bucket limits the request rate;
+    - the number of concurrent calls is halved whenever a call is throttled and
+      increased by one after every `ramp_up_successes` successful calls, up to max_concurrency;
+    - throttled calls are retried after the Retry-After time if provided,
+      otherwise after a jittered exponential backoff.
+    Time spent waiting for the limiter is recorded so the cost of throttling is visible.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        rate: float,
+        max_concurrency: int,
+        is_throttled: Callable[[Exception], Throttled | None],
+        max_retries: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        ramp_up_successes: int = 20,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, capacity=max(1.0, rate))
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.is_throttled = is_throttled
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ramp_up_successes = ramp_up_successes
+
+        self.condition = threading.Condition()
+        # Coroutines waiting for a slot, as (event loop, future) in the order that they arrived
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self.decreased_at = 0.0
+        self.in_flight = 0
+        self.successes = 0
+        self.calls = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def call(self, fn, *args, **kwargs):
+        "Calls fn(*args, **kwargs), waiting for the limiter and retrying if throttled"
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            with self.condition:
+                while self.in_flight >= self.concurrency:
+                    self.condition.wait()
+                self.in_flight += 1
+            try:
+                time.sleep(self.bucket.reserve())
+                self._add_wait(time.monotonic() - started)
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not (throttled := self.is_throttled(e)) or attempt == self.max_retries:
+                    raise
+                delay = self._throttled(throttled, attempt)
+            else:
+                self._succeeded()
+                return result
+            finally:
+                self._release()
+            time.sleep(delay)
+            self._add_wait(delay)
+
+    async def acall(self, coro_fn, *args, **kwargs):
+        "Same as call() for a coroutine function, without blocking the event loop"
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await self._aenter()
+            try:
+                await asyncio.sleep(self.bucket.reserve())
+                self._add_wait(time.monotonic() - started)
+                result = await coro_fn(*args, **kwargs)
+            except Exception as e:
+                if not (throttled := self.is_throttled(e)) or attempt == self.max_retries:
+                    raise
+                delay = self._throttled(throttled, attempt)
+            else:
+                self._succeeded()
+                return result
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+            self._add_wait(delay)
+
+    async def _aenter(self):
+        "Waits for a slot without blocking the event loop, until _release() wakes the coroutine"
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < self.concurrency:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.condition:
+                    if (loop, waiter) in self.async_waiters:
+                        self.async_waiters.remove((loop, waiter))
+                    else:
+                        # Pass on the wakeup that this coroutine can no longer use
+                        self._wake_async_waiters()
+                raise
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+            self._wake_async_waiters()
+
+    def _wake_async_waiters(self):
+        "Wakes as many waiting coroutines as there are free slots; the condition must be held"
+        free = self.concurrency - self.in_flight
+        while free > 0 and self.async_waiters:
+            loop, waiter = self.async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+                free -= 1
+            except RuntimeError:
+                # The event loop was closed
+                pass
+
+    def _add_wait(self, seconds: float):
+        with self.condition:
+            self.wait_seconds += seconds
+
+    def _succeeded(self):
+        with self.condition:
+            self.calls += 1
+            self.successes += 1
+            if self.successes >= self.ramp_up_successes and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+                self.condition.notify_all()
+                self._wake_async_waiters()
+
+    def _throttled(self, throttled: Throttled, attempt: int) -> float:
+        "Reduces concurrency and returns how long to wait before retrying"
+        with self.condition:
+            self.calls += 1
+            self.throttled += 1
+            self.successes = 0
+            # Calls that were in flight together are usually throttled together,
+            # so only reduce concurrency once per second
+            if time.monotonic() - self.decreased_at > 1.0:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.decreased_at = time.monotonic()
+        if throttled.retry_after is not None:
+            delay = throttled.retry_after
+        else:
+            # "Full jitter" exponential backoff
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        logger.warning(
+            "%s throttled (HTTP %s); concurrency=%i; retrying in %.1fs",
+            self.name,
+            throttled.status,
+            self.concurrency,
+            delay,
+        )
+        return delay
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "wait_seconds": self.wait_seconds,
+                "concurrency": self.concurrency,
+            }
+
+    def describe_since(self, previous_stats: dict) -> str:
+        "Summarizes the limiter's activity since previous_stats = stats()"
+        current = self.stats()
+        calls = current["calls"] - previous_stats["calls"]
+        throttled = current["throttled"] - previous_stats["throttled"]
+        wait_seconds = current["wait_seconds"] - previous_stats["wait_seconds"]
+        return (
+            f"{self.name}: {calls} requests, {throttled} throttled,"
+            f" {wait_seconds:.1f}s spent waiting for the rate limiter"
+        )
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def is_http_response_throttled(e: Exception) -> Throttled | None:
+    "For requests.HTTPError (e.g., raised by atlassian.Confluence) and httpx.HTTPStatusError"
+    response = getattr(e, "response", None)
+    if response is None or response.status_code not in (429, 503):
+        return None
+    return Throttled(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+
+
+def is_google_throttled(e: Exception) -> Throttled | None:
+    "For googleapiclient.errors.HttpError"
+    resp = getattr(e, "resp", None)
+    if resp is None:
+        return None
+    status = int(resp.status)
+    # https://developers.google.com/workspace/drive/api/guides/limits
+    if status == 403:
+        details = getattr(e, "error_details", None)
+        reasons = [d.get("reason") for d in details if isinstance(d, dict)] if details else []
+        if not {"rateLimitExceeded", "userRateLimitExceeded"} & set(reasons):
+            return None
+    elif status not in (429, 503):
+        return None
+    return Throttled(status, parse_retry_after(resp.get("retry-after")))
+
+
+LIMITER_SETTINGS = {
+    # Shared by ConfluenceClient and AsyncConfluenceClient
+    "Confluence": {
+        "rate": float(os.environ.get("CONFLUENCE_RATE_LIMIT", 20)),
+        "max_concurrency": int(os.environ.get("CONFLUENCE_MAX_CONCURRENCY", 100)),
+        "is_throttled": is_http_response_throttled,
+    },
+    "GDrive": {
+        "rate": float(os.environ.get("GDRIVE_RATE_LIMIT", 10)),
+        "max_concurrency": int(os.environ.get("GDRIVE_MAX_CONCURRENCY", 8)),
+        "is_throttled": is_google_throttled,
+    },
+}
+
+_limiters: dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    "Returns the limiter shared by all clients of the named service"
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **LIMITER_SETTINGS[name])
+        return _limiters[name]
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from atomic_write import atomic_write, replace_file
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Thread-safe on-disk cache of JSON-serializable responses that survives process restarts.
+    Entries are evicted in least-recently-used order once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, folder: str, max_bytes: int = 500 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        # Rebuild the LRU order from the files' modification times, which are updated on access
+        files = [e for e in os.scandir(folder) if e.is_file() and e.name.endswith(".json")]
+        files.sort(key=lambda e: e.stat().st_mtime)
+        self.entries: OrderedDict[str, int] = OrderedDict((e.name, e.stat().st_size) for e in files)
+        self.total_bytes = sum(self.entries.values())
+        logger.info(
+            "Cache %r has %i entries (%i bytes)", folder, len(self.entries), self.total_bytes
+        )
+
+    def _filename(self, key: str) -> str:
+        return f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+    def get(self, key: str, max_age: float | None = None):
+        "Returns the cached value, or None if it is missing or older than max_age seconds"
+        filename = self._filename(key)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+        # Files are read and written outside the lock, which is only held for the LRU bookkeeping
+        # and for renaming and removing files
+        path = os.path.join(self.folder, filename)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            # Evicted since it was looked up
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Dropping unreadable cache entry %r: %s", key, e)
+            with self.lock:
+                if filename in self.entries:
+                    self._remove(filename)
+            return None
+        if entry["key"] != key:
+            return None
+        if max_age is not None and time.time() - entry["stored_at"] > max_age:
+            return None
+        with self.lock:
+            if filename in self.entries:
+                self.entries.move_to_end(filename)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def set(self, key: str, value):
+        filename = self._filename(key)
+        data = json.dumps({"key": key, "stored_at": time.time(), "value": value}).encode()
+
+        def replace(tmp_path: str, path: str) -> bool:
+            with self.lock:
+                replace_file(tmp_path, path)
+                self.total_bytes += len(data) - self.entries.pop(filename, 0)
+                self.entries[filename] = len(data)
+                while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                    self._remove(next(iter(self.entries)))
+            return True
+
+        atomic_write(
+            os.path.join(self.folder, filename), lambda f: f.write(data), mode="wb", replace=replace
+        )
+
+    def _remove(self, filename: str):
+        self.total_bytes -= self.entries.pop(filename)
+        try:
+            os.remove(os.path.join(self.folder, filename))
+        except FileNotFoundError:
+            pass
@@ -7,11 +7,12 @@ from queue import Queue
 
 import pandas as pd
 import streamlit as st
-from anytree import PreOrderIter
 from streamlit_tree_select import tree_select
 
+import rate_limit
 import ui_helper
-from ui_helper import PageNode, StreamlitThreader
+from tree_snapshot import TREE_SNAPSHOT_DIR, TreeSnapshots
+from ui_helper import StreamlitThreader
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,12 +29,54 @@ def _query_confluence_spaces():
     return ui_helper.create_confluence_ops(ss).get_confluence_spaces()
 
 
-@st.cache_data
-def _build_tree(space_key, page_title):
-    root_node = ui_helper.create_confluence_ops(ss).query_pages_as_tree(space_key, page_title)
-    for n in PreOrderIter(root_node):
-        n.include = n.to_export = True
-    return root_node
+@st.cache_resource
+def _tree_cache() -> dict:
+    "Trees shared across sessions, keyed by Confluence URL, user, space key and page title"
+    return {}
+
+
+@st.cache_resource
+def _tree_snapshots() -> TreeSnapshots | None:
+    return TreeSnapshots(TREE_SNAPSHOT_DIR) if TREE_SNAPSHOT_DIR else None
+
+
+def _build_tree(
+    space_key, page_title, modified_after=None, on_progress=None, refresh=False, requery=False
+):
+    """
+    Returns the tree from memory or from a snapshot on disk. If refresh, the tree is updated
+    with the pages modified since it was queried. If requery (or if there is no tree),
+    the pages (modified after modified_after, if given) are queried from Confluence.
+    """
+    # st.cache_data is not used because on_progress renders elements created outside the cached
+    # function, which st.cache_data cannot replay
+    confluence_ops = ui_helper.create_confluence_ops(ss)
+    # Trees are kept per user since the pages in them depend on the user's permissions
+    cache_key = (
+        ss.confl_base_url,
+        confluence_ops.cclient.user_hash[:16],
+        space_key,
+        page_title,
+        modified_after.isoformat() if modified_after else None,
+    )
+    tree = None if requery else _tree_cache().get(cache_key)
+    snapshots = _tree_snapshots()
+    if not tree and not requery and snapshots:
+        tree = snapshots.load(cache_key)
+    queried = refresh or not tree
+    if tree and refresh:
+        # Update a copy so that sessions using the cached tree are not affected until it is replaced
+        tree = confluence_ops.refresh_tree(tree.copy(), space_key)
+    elif not tree:
+        # All pages start out included and selected for export
+        tree = confluence_ops.query_pages_as_tree(
+            space_key, page_title, on_progress=on_progress, modified_after=modified_after
+        )
+    if queried and snapshots:
+        snapshots.save(cache_key, tree)
+    _tree_cache()[cache_key] = tree
+    # Like st.cache_data, return a copy so that selections are not shared across sessions
+    return _tree_cache()[cache_key].copy()
 
 
 st.header("➡️ Export Confluence pages")
@@ -41,7 +84,7 @@ st.header("➡️ Export Confluence pages")
 if "confl_base_url" not in ss:
     ss.confl_base_url = ui_helper.create_confluence_ops(ss).confluence_api_url()
 
-spaces_expanded = (not ss.root_node and not ss.spaces) or not ss.space_name
+spaces_expanded = (not ss.page_tree and not ss.spaces) or not ss.space_name
 with st.expander("List spaces", expanded=bool(spaces_expanded)):
 
     def query_spaces():
@@ -99,26 +142,53 @@ def reset_tree(manual_select_expanded=None):
         ss.manual_select_expanded = manual_select_expanded
 
 
-def build_tree_for_pages():
+def build_tree_for_pages(refresh=False, requery=False):
     logger.info(f"build_tree_for_pages: {ss.input_space_key} {ss.input_page_title!r}")
     # Reset any previous query error
     ss.query_error = None
-    ss.root_node = None
+    ss.page_tree = None
+    progress_placeholder = st.empty()
+    last_progress_time = 0.0
+
+    def show_progress(partial_root_node, page_count):
+        nonlocal last_progress_time
+        # Limit how often the partial tree is rendered
+        if time.time() - last_progress_time < 0.5:
+            return
+        last_progress_time = time.time()
+        with progress_placeholder.container(border=True):
+            st.write(f"Pages found so far: `{page_count}`")
+            st.code(ui_helper.render_tree_text(partial_root_node), language=None)
+
     try:
-        if ss.input_space_key and ss.input_page_title:
+        if ss.input_space_key:
+            # A blank page title queries all pages in the space
             with st.spinner("Querying Confluence pages...", show_time=True):
-                ss.root_node = _build_tree(ss.input_space_key, ss.input_page_title)
+                modified_after = None
+                if ss.chkbox_query_modified_after:
+                    modified_after = datetime.combine(
+                        ss.input_query_modified_after, datetime.min.time()
+                    )
+                ss.page_tree = _build_tree(
+                    ss.input_space_key,
+                    ss.input_page_title,
+                    modified_after,
+                    on_progress=show_progress,
+                    refresh=refresh,
+                    requery=requery,
+                )
     except Exception as e:
         logger.exception(e)
         ss.query_error = e
+    progress_placeholder.empty()
 
     print("ss.query_error=", ss.query_error)
-    logger.info(ss.root_node)
+    logger.info(ss.page_tree)
     reset_tree()
     ss.reset_previous_export = True
 
 
-with st.expander("**Query page and its subpages**", expanded=not ss.root_node):
+with st.expander("**Query page and its subpages**", expanded=not ss.page_tree):
 
     def find_space(space_key):
         try:
@@ -149,32 +219,90 @@ with st.expander("**Query page and its subpages**", expanded=not ss.root_node):
     #     st.write(f"Homepage: `{found_space["homepage_title"]}`")
 
     st.text_input(
-        "Confluence page title",  # TODO: "(leave blank to get all pages)",
+        "Confluence page title (leave blank to get all pages)",
         key="input_page_title",
         placeholder="Title of Confluence page",
     )
 
+    modified_after_col, modified_date_col = st.columns(2, vertical_alignment="bottom")
+    modified_after_col.checkbox(
+        "Only query pages modified after",
+        key="chkbox_query_modified_after",
+        help="Unmodified pages are not queried, except for the ancestors of modified pages,"
+        " which are shown as stubs",
+    )
+    modified_date_col.date_input(
+        "Modified after",
+        key="input_query_modified_after",
+        format="YYYY-MM-DD",
+        disabled=not ss.chkbox_query_modified_after,
+        label_visibility="collapsed",
+    )
+
     # Gotcha: Use the `on_click=` callback (rather than `if st.button(...):`) to disable the button after a click
     # https://discuss.streamlit.io/t/streamlit-button-disable-enable/31293
     # https://docs.streamlit.io/develop/api-reference/caching-and-state/st.session_state#use-callbacks-to-update-session-state
-    query_pages_input_missing = (
-        not ss.confl_base_url or not ss.input_space_key or not ss.input_page_title
-    )
+    query_pages_input_missing = not ss.confl_base_url or not ss.input_space_key
     st.button(
-        "Query page and its subpages",
+        "Query page and its subpages" if ss.input_page_title else "Query all pages in the space",
         disabled=query_pages_input_missing,
         on_click=build_tree_for_pages,
     )
 
+    if not ss.input_page_title and ss.export_folder:
+
+        def start_space_exporter_thread():
+            _space_key = ss.input_space_key
+            _export_folder = ss.export_folder
+            _confluence_ops = ui_helper.create_confluence_ops(ss)
+            _incremental = ss.chkbox_incremental_export
+
+            def export_space(queue: Queue):
+                queue.put(f"Exporting all pages in space `{_space_key}` to `{_export_folder}`")
+                _confluence_ops.export_space_html_folder(
+                    _space_key, _export_folder, queue, incremental=_incremental
+                )
+
+            ss.export_threader.start_thread(export_space)
+
+        st.button(
+            "Export all pages in the space without selecting pages",
+            help="Pages are exported as they are listed, which is fastest for large spaces",
+            disabled=query_pages_input_missing or ss.export_threader.is_alive(),
+            on_click=start_space_exporter_thread,
+        )
+
     if ss.query_error:
         st.error(
             f"Error querying `{ss.input_page_title}` in space **{ss.input_space_key}**: {ss.query_error}"
         )
 
+if ss.page_tree:
+    age_col, refresh_col, requery_col = st.columns(3, vertical_alignment="bottom")
+    age_col.write(
+        f"Pages under `{ss.page_tree.root_title}` were queried"
+        f" {ui_helper.describe_age(ss.page_tree.crawled_at)}"
+    )
+    refresh_col.button(
+        "Refresh pages from Confluence",
+        help="Queries only the pages modified since then."
+        " Pages are reloaded from a saved snapshot until refreshed.",
+        disabled=query_pages_input_missing,
+        on_click=build_tree_for_pages,
+        kwargs={"refresh": True},
+    )
+    requery_col.button(
+        "Query all pages again",
+        help="Also picks up pages that were moved without being modified",
+        disabled=query_pages_input_missing,
+        on_click=build_tree_for_pages,
+        kwargs={"requery": True},
+    )
+
 with st.expander("Filter pages by date", expanded=False):
-    # ss.root_node will be None if query fails
-    if ss.root_node:
-        page_count = sum(1 for _ in PreOrderIter(ss.root_node))
+    # ss.page_tree will be None if query fails
+    if ss.page_tree:
+        page_count = ss.page_tree.page_count
         st.subheader(f"Pages found: `{page_count}`")
 
         with st.form("date_filter_form", enter_to_submit=False):
@@ -188,21 +316,25 @@ with st.expander("Filter pages by date", expanded=False):
             timestamp = datetime.strptime(f"{after_date}T{after_time}Z", "%Y-%m-%dT%H:%M:%SZ")
 
             if filter_btn_col.form_submit_button("Filter"):
-                ui_helper.exclude_old_nodes(ss.root_node, timestamp)
+                ui_helper.exclude_old_nodes(ss.page_tree, timestamp)
                 ss.reset_previous_export = True
 
-        excluded_count = sum(1 for n in PreOrderIter(ss.root_node) if not n.include)
+        excluded_count = ss.page_tree.excluded_count
 
         st.write(f"{excluded_count} pages excluded")
 
-        def page_included_style(val: dict) -> list[str]:
-            style = "background-color: green" if val["include"] else "color: gray"
-            # Use the same style for all val's attributes
-            return [style if attr == "include" else "" for attr in val.keys()]
+        def page_included_style(include: pd.Series) -> pd.Series:
+            return include.map({True: "background-color: green", False: "color: gray"})
+
+        def build_page_table():
+            page_df = pd.DataFrame(ui_helper.page_rows(ss.page_tree)).set_index("id")
+            # Styles the include column as a whole rather than calling a function per row
+            return page_df.style.apply(page_included_style, subset=["include"])
 
-        page_nodes = [PageNode(n).as_row() for n in PreOrderIter(ss.root_node)]
         st.dataframe(
-            data=pd.DataFrame(page_nodes).set_index("id").style.apply(page_included_style, axis=1),
+            data=ui_helper.cached_view(
+                ss, "page_table", ss.page_tree, ss.page_tree.include_version, build_page_table
+            ),
             hide_index=True,
             column_order=["include", "link", "modified", "parent"],
             column_config={
@@ -215,7 +347,7 @@ with st.expander("Filter pages by date", expanded=False):
         )
 
 with st.expander("Manually select pages to export", expanded=ss.manual_select_expanded):
-    if ss.root_node:
+    if ss.page_tree:
         # st.subheader("Page hierarchy")
         if st.button(
             "Refresh/reset page hierarchy to match included pages above",
@@ -227,8 +359,36 @@ with st.expander("Manually select pages to export", expanded=ss.manual_select_ex
             # Cause previous export to be reset
             ss.reset_previous_export = True
 
-        tree_nodes = ui_helper.generate_dict_from_tree(ss.root_node)
-        included_ids = [node.id for node in PreOrderIter(ss.root_node) if node.include]
+        if ss.page_tree.modified_after is not None:
+
+            def count_stale_pages():
+                ui_helper.create_confluence_ops(ss).count_stale_pages(
+                    ss.page_tree, ss.input_space_key
+                )
+
+            st.button(
+                "Count unmodified subpages that were not queried",
+                help="Makes a request per page shown as unmodified",
+                disabled=bool(ss.page_tree.stale_counts),
+                on_click=count_stale_pages,
+            )
+
+        # The hierarchy does not change for a given tree, so it is only rebuilt
+        # when stale page counts are added to the labels
+        tree_nodes = ui_helper.cached_view(
+            ss,
+            "tree_nodes",
+            ss.page_tree,
+            len(ss.page_tree.stale_counts),
+            lambda: ui_helper.generate_dict_from_tree(ss.page_tree),
+        )
+        included_ids = ui_helper.cached_view(
+            ss,
+            "included_ids",
+            ss.page_tree,
+            ss.page_tree.include_version,
+            lambda: ss.page_tree.ids_where(ss.page_tree.include),
+        )
         tree_state = tree_select(
             tree_nodes,
             checked=included_ids,
@@ -237,11 +397,16 @@ with st.expander("Manually select pages to export", expanded=ss.manual_select_ex
         )
 
         # Update nodes based on tree selections
-        for n in PreOrderIter(ss.root_node):
-            n.to_export = n.id in tree_state["checked"]
-        to_export_node_ids = [node.id for node in PreOrderIter(ss.root_node) if node.to_export]
+        ss.page_tree.set_to_export_ids(tree_state["checked"])
+        to_export_node_ids = ui_helper.cached_view(
+            ss,
+            "to_export_ids",
+            ss.page_tree,
+            ss.page_tree.to_export_version,
+            lambda: ss.page_tree.ids_where(ss.page_tree.to_export),
+        )
 
-        selections_differ = set(included_ids) != set(to_export_node_ids)
+        selections_differ = ss.page_tree.include != ss.page_tree.to_export
 
 
 if ss.reset_previous_export:
@@ -250,44 +415,80 @@ if ss.reset_previous_export:
     ss.reset_previous_export = False
 
 with st.expander("**Export to HTML**", expanded=True):
-    if ss.root_node:
+    if ss.page_tree:
         st.write(f"Pages selected for export: `{len(to_export_node_ids)}`")
 
         if not ss.export_folder:
             st.error("Export folder is not set correcly in **Advanced settings**.")
         else:
-            st.write(f"Export folder: `{ss.export_folder}`")
+            st.radio(
+                "Export to",
+                list(ui_helper.EXPORT_TARGETS),
+                key="radio_export_target",
+                horizontal=True,
+                help="An archive is a single file, which is faster to write and delete"
+                " than many small files. It is rewritten on every export.",
+            )
+            archive_path = ui_helper.export_archive_path(ss)
+            if archive_path:
+                st.write(f"Export archive: `{archive_path}`")
+            else:
+                st.write(f"Export folder: `{ss.export_folder}`")
 
             delete_folder = st.checkbox(
                 "Empty/delete folder before exporting",
                 key="chkbox_delete_folder_before_export",
+                disabled=bool(archive_path),
+            )
+            incremental = st.checkbox(
+                "Skip pages that have not changed since they were last exported to this folder",
+                key="chkbox_incremental_export",
+                disabled=delete_folder or bool(archive_path),
+            )
+            attachments = st.checkbox(
+                "Download images and attachments into the export folder",
+                key="chkbox_export_attachments",
+                disabled=bool(archive_path),
             )
 
             def start_exporter_thread():
                 # ss itself cannot be accessed in a different thread,
                 # so extract desired variables for export_pages() to use in separate thread
-                _root_node = ss.root_node
+                _page_tree = ss.page_tree
                 _export_folder = ss.export_folder
-                _export_html_folder = ui_helper.create_confluence_ops(ss).export_html_folder
+                _archive_path = archive_path
+                _confluence_ops = ui_helper.create_confluence_ops(ss)
+                _incremental = incremental and not delete_folder
+                _attachments = attachments
+                _limiter = rate_limit.get_limiter("Confluence")
 
                 def export_pages(queue: Queue):
                     # check if export_folder exists
-                    if delete_folder and os.path.exists(_export_folder):
+                    if delete_folder and not _archive_path and os.path.exists(_export_folder):
                         queue.put(f"Deleting folder {_export_folder}")
                         shutil.rmtree(_export_folder)
 
-                    node_ids = [n.id for n in PreOrderIter(_root_node) if n.to_export]
-                    if not node_ids:
+                    if not _page_tree.to_export_count:
                         logger.info("Nothing to export")
                         return
 
-                    os.makedirs(_export_folder, exist_ok=True)
-                    logger.info("node_ids to export: %r", node_ids)
-                    # Update original n.include so that a refresh retains selections
-                    for n in PreOrderIter(_root_node):
-                        n.include = n.to_export
-
-                    _export_html_folder(_root_node, _export_folder, queue=queue)
+                    logger.info("Pages to export: %i", _page_tree.to_export_count)
+                    # Update the original include flags so that a refresh retains selections
+                    _page_tree.include_to_export()
+
+                    limiter_stats = _limiter.stats()
+                    if _archive_path:
+                        _confluence_ops.export_html_archive(_page_tree, _archive_path, queue=queue)
+                    else:
+                        os.makedirs(_export_folder, exist_ok=True)
+                        _confluence_ops.export_html_folder(
+                            _page_tree,
+                            _export_folder,
+                            queue=queue,
+                            incremental=_incremental,
+                            attachments=_attachments,
+                        )
+                    queue.put(_limiter.describe_since(limiter_stats))
 
                 ss.export_threader.start_thread(export_pages)
 
@@ -297,6 +498,6 @@ with st.expander("**Export to HTML**", expanded=True):
                 on_click=start_exporter_thread,
             )
 
-# if ss.root_node:
+# if ss.page_tree:
 ss.export_threader.create_status_container(st)
 # ss
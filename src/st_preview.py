@@ -1,12 +1,25 @@
+import os
+
 import streamlit as st
+from streamlit_embeded import st_embeded
 from streamlit_file_browser import st_file_browser
 import ui_helper
+from export_archive import ExportArchive
 
 ss = st.session_state
 ui_helper.retain_session_state(ss)
 st.header("🔍 Preview exported pages")
 
-if ss.export_folder:
+archive_path = ui_helper.export_archive_path(ss)
+if archive_path:
+    if not os.path.exists(archive_path):
+        st.write("Export pages first in order to preview them")
+    else:
+        st.write(f"Export archive: `{archive_path}`")
+        with ExportArchive(archive_path) as archive:
+            if html_file := st.selectbox("Page", archive.html_files(), index=None):
+                st_embeded(archive.open(html_file).read().decode("utf-8"))
+elif ss.export_folder:
     st.write(f"Export folder: `{ss.export_folder}`")
     st.write("Click on a file to preview its contents at the bottom of the page")
 
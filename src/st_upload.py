@@ -6,6 +6,7 @@ from queue import Queue
 import streamlit as st
 
 import gdrive_client
+from export_archive import ExportArchive
 import main
 import ui_helper
 
@@ -20,7 +21,9 @@ st.write(
 )
 
 
-if not os.path.exists(ss.export_folder):
+archive_path = ui_helper.export_archive_path(ss)
+export_path = archive_path or ss.export_folder
+if not export_path or not os.path.exists(export_path):
     st.write("Export pages to HTML before uploading to GDrive.")
 else:
 
@@ -30,6 +33,7 @@ else:
         service_info = json.loads(ss.input_gdrive_credentials) if ss.input_gdrive_credentials else None
         _gclient = gdrive_client.GDriveClient(service_info)
         _source_folder = ss.export_folder
+        _archive_path = archive_path
         _gdrive_folder_id = ss.input_gdrive_folder_id
         _dry_run = ss.chkbox_dry_run_upload
         _skip_existing = ss.chkbox_skip_existing_gdrive_files
@@ -38,15 +42,31 @@ else:
         def upload_files(queue: Queue):
             if _dry_run:
                 queue.put("Starting dry run ...")
-            main.sync_folder_to_gdrive(
-                _gclient,
-                _source_folder,
-                _gdrive_folder_id,
-                queue,
-                skip_existing=_skip_existing,
-                delete_gfiles=_delete_gfiles,
-                dry_run=_dry_run,
-            )
+            limiter_stats = _gclient.limiter.stats()
+            if _archive_path:
+                # Read the files straight from the archive
+                with ExportArchive(_archive_path) as archive:
+                    main.sync_folder_to_gdrive(
+                        _gclient,
+                        "",
+                        _gdrive_folder_id,
+                        queue,
+                        skip_existing=_skip_existing,
+                        delete_gfiles=_delete_gfiles,
+                        dry_run=_dry_run,
+                        source=archive,
+                    )
+            else:
+                main.sync_folder_to_gdrive(
+                    _gclient,
+                    _source_folder,
+                    _gdrive_folder_id,
+                    queue,
+                    skip_existing=_skip_existing,
+                    delete_gfiles=_delete_gfiles,
+                    dry_run=_dry_run,
+                )
+            queue.put(_gclient.limiter.describe_since(limiter_stats))
 
         ss.upload_threader.start_thread(upload_files)
 
@@ -84,8 +104,11 @@ else:
 
     with st.container(border=True):
         st.write(
-            f"Once upload is complete, delete the exported HTML files in `{ss.export_folder}` if you're done with them."
+            f"Once upload is complete, delete the exported HTML files in `{export_path}` if you're done with them."
         )
         if st.button("Delete exported files"):
-            shutil.rmtree(ss.export_folder)
-            st.write(f"Delete exported files: `{ss.export_folder}`")
+            if archive_path:
+                os.remove(archive_path)
+            else:
+                shutil.rmtree(ss.export_folder)
+            st.write(f"Delete exported files: `{export_path}`")
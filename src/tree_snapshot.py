@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from atomic_write import atomic_write
+from page_tree import PageTree
+
+logger = logging.getLogger(__name__)
+
+# Folder of crawled page trees that are reloaded instead of querying Confluence again;
+# set to an empty string to disable snapshots
+TREE_SNAPSHOT_DIR = os.environ.get("TREE_SNAPSHOT_DIR", "./.tree_snapshots")
+# Snapshots beyond the most recently used TREE_SNAPSHOT_MAX_COUNT, or not used for
+# TREE_SNAPSHOT_MAX_DAYS, are deleted
+TREE_SNAPSHOT_MAX_COUNT = int(os.environ.get("TREE_SNAPSHOT_MAX_COUNT", 100))
+TREE_SNAPSHOT_MAX_DAYS = float(os.environ.get("TREE_SNAPSHOT_MAX_DAYS", 30))
+# Incremented when the snapshot format changes so that older snapshots are ignored
+SNAPSHOT_FORMAT = 2
+
+
+class TreeSnapshots:
+    """
+    Saves crawled page trees as gzipped JSON columns, keyed by Confluence URL, space key,
+    page title and any other query parameters, so that a restarted or new process can reload
+    a tree instead of recrawling it. Keys should identify the user, whose permissions
+    determine which pages are in the tree.
+    Snapshots are deleted in least-recently-used order once there are more than max_count,
+    and once they have not been used for max_days.
+    """
+
+    def __init__(
+        self,
+        folder: str = TREE_SNAPSHOT_DIR,
+        max_count: int = TREE_SNAPSHOT_MAX_COUNT,
+        max_days: float = TREE_SNAPSHOT_MAX_DAYS,
+    ):
+        self.folder = folder
+        self.max_count = max_count
+        self.max_days = max_days
+        os.makedirs(folder, exist_ok=True)
+        self._prune()
+
+    def _path(self, key: tuple) -> str:
+        key_str = json.dumps(key)
+        return os.path.join(self.folder, f"{hashlib.sha256(key_str.encode()).hexdigest()}.json.gz")
+
+    def load(self, key: tuple) -> PageTree | None:
+        "Returns the saved tree, or None if there is no usable snapshot"
+        path = self._path(key)
+        if not os.path.isfile(path) or self._expired(os.path.getmtime(path)):
+            return None
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            if data["format"] != SNAPSHOT_FORMAT:
+                return None
+            tree = PageTree.from_dict(data["tree"])
+            # The modification time records when the snapshot was last used
+            os.utime(path)
+            return tree
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable tree snapshot %r: %s", path, e)
+            return None
+
+    def save(self, key: tuple, tree: PageTree):
+        path = self._path(key)
+        data = {
+            "format": SNAPSHOT_FORMAT,
+            "key": key,
+            "tree": tree.to_dict(),
+        }
+        atomic_write(path, lambda f: json.dump(data, f), mode="wt", opener=gzip.open)
+        logger.info("Saved tree snapshot of %i pages to %r", len(tree), path)
+        self._prune()
+
+    def _expired(self, used_at: float) -> bool:
+        return time.time() - used_at > self.max_days * 24 * 3600
+
+    def _prune(self):
+        "Deletes expired snapshots and the least recently used ones beyond max_count"
+        snapshots = sorted(
+            (e.stat().st_mtime, e.path)
+            for e in os.scandir(self.folder)
+            if e.is_file() and e.name.endswith(".json.gz")
+        )
+        for k, (used_at, path) in enumerate(snapshots):
+            if k < len(snapshots) - self.max_count or self._expired(used_at):
+                try:
+                    os.remove(path)
+                    logger.info("Deleted tree snapshot %r", path)
+                except FileNotFoundError:
+                    pass
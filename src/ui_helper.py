@@ -1,11 +1,16 @@
+import itertools
 import logging
 import os
 import time
+from datetime import date, timedelta
 from queue import Queue
 from threading import Thread
+from typing import Any, Callable
 
-from anytree import Node, PreOrderIter
+from anytree import RenderTree
+from export_archive import archive_path
 from main import ConfluenceOps
+from page_tree import PageTree
 from streamlit_embeded import st_embeded
 
 logger = logging.getLogger(__name__)
@@ -42,13 +47,18 @@ def set_missing_initial_state(ss):
         "input_page_title": "",
         "input_gdrive_folder_id": os.environ.get("GDRIVE_FOLDER_ID"),
         "chkbox_change_gdrive_folder_id": False,
+        "chkbox_query_modified_after": False,
+        "input_query_modified_after": date.today() - timedelta(days=7),
         "chkbox_delete_folder_before_export": False,
+        "chkbox_incremental_export": False,
+        "chkbox_export_attachments": False,
+        "radio_export_target": "Folder",
         "chkbox_dry_run_upload": False,
         "chkbox_skip_existing_gdrive_files": False,
         "chkbox_delete_unmatched_files": False,
         # Populated upon data retrieval
         "spaces": None,  # Populated if user queries spaces
-        "root_node": None,  # Populated when user queries pages
+        "page_tree": None,  # Populated when user queries pages
         # Derived from input fields
         "space_name": None,  # Derived from input_space_key
         # Used to affect UI state
@@ -71,6 +81,18 @@ def set_missing_initial_state(ss):
         ss.export_folder = f"./exports/{ss.input_profile_name}"
 
 
+# Export target option -> archive format, or None to export to a folder
+EXPORT_TARGETS = {"Folder": None, "Zip archive": "zip", "Tar archive": "tar"}
+
+
+def export_archive_path(ss) -> str | None:
+    "Returns the archive to export to and read from, or None if ss.export_folder is used instead"
+    archive_format = EXPORT_TARGETS[ss.radio_export_target]
+    if not archive_format or not ss.export_folder:
+        return None
+    return archive_path(ss.export_folder, archive_format)
+
+
 def create_confluence_ops(ss):
     return ConfluenceOps(
         # Empty values will default to using environment variables
@@ -80,49 +102,86 @@ def create_confluence_ops(ss):
     )
 
 
-class PageNode:
-    def __init__(self, node: Node):
-        self.node = node
+def cached_view(ss, name: str, tree: PageTree, version: int, build: Callable[[], Any]):
+    """
+    Returns the view built by build() for the tree, caching it in session state until the
+    tree is replaced or version changes
+    """
+    key = f"view_{name}"
+    cached = ss.get(key)
+    if not cached or cached[0] is not tree or cached[1] != version:
+        cached = ss[key] = (tree, version, build())
+    return cached[2]
+
+
+def page_rows(tree: PageTree) -> dict[str, list]:
+    "Returns the columns of a table with a row per page"
+    return {
+        "id": tree.ids,
+        "title": tree.titles,
+        # Stubs are not queried, so their modification times are unknown
+        "modified": [None if tree.is_stub(i) else tree.modified_at(i) for i in range(len(tree))],
+        "parent": [tree.titles[p] if p >= 0 else None for p in tree.parents],
+        "include": [bool(flag) for flag in tree.include],
+        "link": [tree.link(i) for i in range(len(tree))],
+    }
 
-    def as_row(self):
-        return {
-            "id": self.node.id,
-            "title": self.node.title,
-            "modified": self.node.modified,
-            "parent": self.node.parent.title if self.node.parent else None,
-            "include": self.node.include,
-            "link": self.node.link,
-        }
+
+def exclude_old_nodes(tree: PageTree, timestamp):
+    logger.info("exclude_old_nodes(%r, %r)", tree.root_title, timestamp)
+    tree.include_modified_since(timestamp)
 
 
-def exclude_old_nodes(root_node, timestamp):
-    logger.info("exclude_old_nodes(%r, %r)", root_node.title, timestamp)
-    for n in PreOrderIter(root_node):
-        n.include = n.modified >= timestamp
-        # logger.info("Node %r: %r >= %r : %r", n.id, n.modified, timestamp, n.include)
+def page_label(tree: PageTree, i: int) -> str:
+    "For a tree queried with modified_after, shows which pages are stubs and how many are stale"
+    labels = ["unmodified"] if tree.is_stub(i) else []
+    if (stale_count := tree.stale_counts.get(tree.ids[i])) is not None:
+        labels.append(f"{stale_count} unmodified subpages not queried")
+    return f"{tree.titles[i]} ({', '.join(labels)})" if labels else tree.titles[i]
 
 
-def generate_dict_from_tree(node):
+def generate_dict_from_tree(tree: PageTree, i: int = 0):
     """
-    Generates a dictionary data structure with nested children nodes from an anytree node.
+    Generates a dictionary data structure with nested children nodes from page i of the tree.
     """
     node_dict = {
-        "label": node.title,
-        "value": node.id,
+        "label": page_label(tree, i),
+        "value": tree.ids[i],
     }
-    if node.children:
+    if tree.has_children(i):
         parent_dict = {
-            "label": f"subpages of '{node.title}'",
-            "value": f"children_{node.id}",
+            "label": f"subpages of '{tree.titles[i]}'",
+            "value": f"children_{tree.ids[i]}",
         }
         parent_dict["children"] = [
-            c for child in node.children for c in generate_dict_from_tree(child)
+            c for child in tree.children(i) for c in generate_dict_from_tree(tree, child)
         ]
         return [node_dict, parent_dict]
 
     return [node_dict]
 
 
+def describe_age(timestamp: float) -> str:
+    "E.g., '5 minutes ago' for a time.time() timestamp"
+    seconds = max(0, time.time() - timestamp)
+    for unit, unit_seconds in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= unit_seconds:
+            count = int(seconds // unit_seconds)
+            return f"{count} {unit}{'s' if count > 1 else ''} ago"
+    return "just now"
+
+
+def render_tree_text(root_node, max_lines=40) -> str:
+    "Renders the first max_lines of the tree as text, e.g., to show a partially built tree"
+    lines = [
+        f"{prefix}{node.title}"
+        for prefix, _, node in itertools.islice(RenderTree(root_node), max_lines + 1)
+    ]
+    if len(lines) > max_lines:
+        lines[max_lines:] = ["..."]
+    return "\n".join(lines)
+
+
 from streamlit_file_browser import PREVIEW_HANDLERS
 
 
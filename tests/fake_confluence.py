@@ -0,0 +1,161 @@
+"A fake of the Confluence REST API, as used through atlassian.Confluence, for tests"
+
+import re
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import confluence_client
+import main
+
+BASE_TIME = datetime(2025, 1, 1)
+
+
+class FakeApi:
+    url = "https://example.atlassian.net/wiki"
+    username = "user"
+    timeout = 10
+
+    def __init__(self, parents: dict[str, str | None]):
+        "parents maps each page id to its parent's id; the root page's parent is None"
+        self.pages = {
+            page_id: {
+                "title": f"Page {page_id}",
+                "parent": parent_id,
+                "modified": BASE_TIME + timedelta(minutes=n),
+                "version": 1,
+                "position": n,
+            }
+            for n, (page_id, parent_id) in enumerate(parents.items())
+        }
+        self.requests: list[tuple[str, str | None]] = []
+
+    # Changes made in Confluence
+
+    def edit(self, page_id, **fields):
+        page = self.pages[page_id]
+        page.update(fields)
+        page["version"] += 1
+        page["modified"] = datetime.utcnow()
+
+    def add(self, page_id, parent_id):
+        self.pages[page_id] = {
+            "title": f"Page {page_id}",
+            "parent": parent_id,
+            "modified": datetime.utcnow(),
+            "version": 1,
+            "position": len(self.pages),
+        }
+
+    def move(self, page_id, parent_id):
+        "Moves a page without modifying it, as Confluence does"
+        self.pages[page_id]["parent"] = parent_id
+
+    def delete(self, page_id):
+        del self.pages[page_id]
+
+    # API
+
+    def ancestor_ids(self, page_id) -> list[str]:
+        ancestor_ids = []
+        while (page_id := self.pages[page_id]["parent"]) is not None:
+            ancestor_ids.insert(0, page_id)
+        return ancestor_ids
+
+    def page(self, page_id, expand: str = "") -> dict:
+        p = self.pages[page_id]
+        page = {
+            "id": page_id,
+            "title": p["title"],
+            "history": {"lastUpdated": {"when": p["modified"].strftime("%Y-%m-%dT%H:%M:%S.000Z")}},
+            "version": {"number": p["version"]},
+            "extensions": {"position": p["position"]},
+            "_links": {"webui": f"/spaces/S/pages/{page_id}"},
+        }
+        if "ancestors" in expand:
+            page["ancestors"] = [
+                {"id": a, "title": self.pages[a]["title"]} for a in self.ancestor_ids(page_id)
+            ]
+        if "space" in expand:
+            page["space"] = {"key": "S", "name": "Space S"}
+        if "body" in expand:
+            page["body"] = {"export_view": {"value": f"<p>{page_id} v{p['version']}</p>"}}
+        return page
+
+    def get_page_id(self, space, title):
+        return next(i for i, p in self.pages.items() if p["title"] == title)
+
+    def get_page_by_id(self, page_id, expand=None):
+        self.requests.append(("page", page_id))
+        return self.page(page_id, expand or "")
+
+    def cql_ids(self, cql: str) -> list[str]:
+        ids = list(self.pages)
+        if m := re.search(r"ancestor = (\w+)", cql):
+            ids = [i for i in ids if m.group(1) in self.ancestor_ids(i)]
+        if m := re.search(r'lastmodified >= "([^"]+)"', cql):
+            since = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M")
+            ids = [i for i in ids if self.pages[i]["modified"] >= since]
+        if m := re.search(r"id in \(([^)]*)\)", cql):
+            ids = [i for i in m.group(1).split(",") if i in self.pages]
+        return ids
+
+    def get(self, path, params=None, absolute=False, **kwargs):
+        if absolute:
+            parsed = urlparse(path)
+            params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            path = parsed.path.removeprefix("/wiki/").lstrip("/")
+        self.requests.append((path, params.get("cql")))
+        if path == "rest/api/search":
+            return {"totalSize": len(self.cql_ids(params["cql"])), "results": []}
+        if path == "rest/api/content/search":
+            ids = self.cql_ids(params["cql"])
+            start, limit = int(params.get("cursor", 0)), int(params["limit"])
+            links = {"base": self.url}
+            if start + limit < len(ids):
+                next_params = urlencode({**params, "cursor": start + limit})
+                links["next"] = f"/rest/api/content/search?{next_params}"
+            return {
+                "results": [
+                    self.page(i, params.get("expand", "")) for i in ids[start : start + limit]
+                ],
+                "limit": limit,
+                "_links": links,
+            }
+        if m := re.match(r"rest/api/content/(\w+)/child/page", path):
+            child_ids = [i for i, p in self.pages.items() if p["parent"] == m.group(1)]
+            start, limit = int(params["start"]), int(params["limit"])
+            return {
+                "results": [
+                    self.page(i, params["expand"]) for i in child_ids[start : start + limit]
+                ],
+                "limit": limit,
+                "_links": {"next": "next"} if start + limit < len(child_ids) else {},
+            }
+        raise ValueError(f"Unexpected request: {path}")
+
+
+def make_client(api: FakeApi, disk_cache=None) -> confluence_client.ConfluenceClient:
+    cclient = confluence_client.ConfluenceClient.__new__(confluence_client.ConfluenceClient)
+    cclient.api = api
+    cclient.disk_cache = disk_cache
+    cclient.body_cache = confluence_client.BodyCache(disk_cache=disk_cache)
+    return cclient
+
+
+def make_ops(api: FakeApi, disk_cache=None) -> main.ConfluenceOps:
+    ops = main.ConfluenceOps.__new__(main.ConfluenceOps)
+    ops.backend = "sync"
+    ops.cclient = make_client(api, disk_cache)
+    return ops
+
+
+def tree_shape(tree) -> dict:
+    "Each page's parent id, title and version"
+    return {
+        tree.ids[i]: (
+            tree.ids[tree.parents[i]] if tree.parents[i] >= 0 else None,
+            tree.titles[i],
+            tree.versions[i],
+        )
+        for i in range(len(tree))
+    }
@@ -0,0 +1,47 @@
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from atomic_write import atomic_write
+from confluence_client import write_if_changed
+
+
+def test_concurrent_writers_of_the_same_path(tmp_path):
+    path = str(tmp_path / "file.json")
+    contents = [str(n) * 100_000 for n in range(8)]
+
+    def write(content):
+        return atomic_write(path, lambda f: [f.write(content[:50_000]), f.write(content[50_000:])])
+
+    with ThreadPoolExecutor(8) as executor:
+        assert all(executor.map(write, contents * 4))
+    assert open(path).read() in contents
+    assert os.listdir(tmp_path) == ["file.json"]
+
+
+def test_failed_write_keeps_the_existing_file(tmp_path):
+    path = str(tmp_path / "file.gz")
+    atomic_write(path, lambda f: f.write("old"), mode="wt", opener=gzip.open)
+
+    def fail(f):
+        f.write("partial")
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        atomic_write(path, fail, mode="wt", opener=gzip.open)
+    with gzip.open(path, "rt") as f:
+        assert f.read() == "old"
+    assert os.listdir(tmp_path) == ["file.gz"]
+
+
+def test_write_if_changed_leaves_identical_file_as_is(tmp_path):
+    path = str(tmp_path / "page.html")
+    assert write_if_changed(path, lambda f: f.write("<p>é</p>"))
+    os.utime(path, (0, 0))
+    assert not write_if_changed(path, lambda f: f.write("<p>é</p>"))
+    assert os.path.getmtime(path) == 0
+    assert write_if_changed(path, lambda f: f.write("<p>e</p>"))
+    assert open(path, encoding="utf-8").read() == "<p>e</p>"
+    assert os.listdir(tmp_path) == ["page.html"]
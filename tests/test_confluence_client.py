@@ -0,0 +1,89 @@
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from confluence_client import ConfluenceClient
+
+
+class FakeSession:
+    "Returns a response with each of the given status codes in turn"
+
+    def __init__(self, statuses: list[int]):
+        self.statuses = statuses
+        self.responses: list[requests.Response] = []
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.url = url
+        response.headers["Retry-After"] = "0"
+        response.raw = io.BytesIO(b"content")
+        self.responses.append(response)
+        return response
+
+
+@pytest.fixture
+def client():
+    return ConfluenceClient(
+        url="https://example.atlassian.net", username="user", api_key="key", cache_dir=None
+    )
+
+
+def test_open_download_closes_failed_response(client):
+    client.api._session = FakeSession([404])
+    with pytest.raises(requests.HTTPError):
+        client.open_download("https://example.atlassian.net/download/attachments/1/a.png")
+    assert client.api._session.responses[0].raw.closed
+
+
+def test_open_download_closes_throttled_response_before_retrying(client):
+    client.api._session = FakeSession([429, 200])
+    with client.open_download("https://example.atlassian.net/download/attachments/1/a.png") as r:
+        assert r.status_code == 200
+        assert not r.raw.closed
+    throttled, _ = client.api._session.responses
+    assert throttled.raw.closed
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OkHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_full_connection_pool_does_not_block(server_url):
+    client = ConfluenceClient(
+        url=server_url, username="user", api_key="key", cache_dir=None, pool_size=1
+    )
+    results = []
+
+    def request():
+        # Streamed responses that are never closed keep their connections checked out
+        leaked = [client.api._session.get(server_url, stream=True) for _ in range(3)]
+        results.append(client.api._session.get(server_url, timeout=5))
+        for response in leaked:
+            response.close()
+
+    # A pool that blocks would wait forever, so run the requests in a thread with a deadline
+    thread = threading.Thread(target=request, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert results and results[0].text == "ok"
@@ -0,0 +1,88 @@
+import random
+from types import SimpleNamespace
+
+from anytree import PreOrderIter
+
+from main import ConfluenceOps
+
+
+class FakeConfluence:
+    "A page hierarchy served like Confluence, with child listings in position order"
+
+    url = "https://example.atlassian.net/wiki"
+
+    def __init__(self, shape: dict[str, list[str]]):
+        self.pages = {}
+        self.children = shape
+        for parent_id, child_ids in shape.items():
+            # Positions are unrelated to ids and titles
+            for position, child_id in zip(random.sample(range(100), len(child_ids)), child_ids):
+                self.pages[child_id] = {"parent": parent_id, "position": position}
+        for child_ids in shape.values():
+            child_ids.sort(key=lambda i: self.pages[i]["position"])
+
+    def ancestors(self, page_id):
+        ancestors = []
+        while (parent_id := self.pages.get(page_id, {}).get("parent")) is not None:
+            ancestors.insert(0, {"id": parent_id})
+            page_id = parent_id
+        return ancestors
+
+    def page(self, page_id):
+        return {
+            "id": page_id,
+            "title": f"Page {page_id}",
+            "history": {"lastUpdated": {"when": "2025-01-01T00:00:00.000Z"}},
+            "version": {"number": 1},
+            "extensions": {"position": self.pages[page_id]["position"]},
+            "_links": {"webui": f"/pages/{page_id}"},
+            "ancestors": self.ancestors(page_id),
+        }
+
+
+class FakeClient:
+    def __init__(self, confluence: FakeConfluence):
+        self.confluence = confluence
+        self.api = SimpleNamespace(url=confluence.url)
+
+    def cache_page_body(self, page):
+        pass
+
+    def get_child_pages(self, page_id, *, include_body=False):
+        return [self.confluence.page(i) for i in self.confluence.children.get(page_id, [])]
+
+    def iter_descendant_pages(self, page_id, *, include_body=False):
+        # Search results come in relevance order, which is unrelated to page order
+        pages = [self.confluence.page(i) for i in self.confluence.pages if i != page_id]
+        random.shuffle(pages)
+        return iter(pages)
+
+
+def make_ops(confluence):
+    ops = ConfluenceOps.__new__(ConfluenceOps)
+    ops.cclient = FakeClient(confluence)
+    return ops
+
+
+def test_cql_tree_keeps_sibling_order():
+    random.seed(1)
+    shape = {"root": ["a", "b", "c", "d"], "a": ["a1", "a2", "a3"], "c": ["c1", "c2"]}
+    shape["a2"] = ["a21", "a22", "a23", "a24"]
+    confluence = FakeConfluence(shape)
+    confluence.pages["root"] = {"parent": None, "position": 0}
+    ops = make_ops(confluence)
+
+    by_cql = ops._create_root_node(
+        {**confluence.page("root"), "space": {"name": "Space"}, "ancestors": []}
+    )
+    progress = SimpleNamespace(pages_added=lambda n: None)
+    assert ops._build_tree_using_cql(by_cql, progress)
+
+    by_level = ops._create_root_node(
+        {**confluence.page("root"), "space": {"name": "Space"}, "ancestors": []}
+    )
+    ops._build_tree_by_level(by_level, progress, False, max_workers=2)
+
+    by_level_ids = [n.id for n in PreOrderIter(by_level)]
+    assert [n.id for n in PreOrderIter(by_cql)] == by_level_ids
+    assert by_level_ids != sorted(by_level_ids)
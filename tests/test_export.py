@@ -0,0 +1,31 @@
+from queue import Queue
+
+from fake_confluence import FakeApi, make_ops
+
+
+def exported_html(folder) -> str:
+    return "".join(p.read_text() for p in sorted(folder.rglob("*.html")))
+
+
+def test_export_checks_versions_of_old_tree(tmp_path):
+    api = FakeApi({"0": None, "a": "0", "b": "0"})
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    ops.export_html_folder(tree, str(tmp_path), Queue(), incremental=True)
+    assert "a v1" in exported_html(tmp_path)
+    api.edit("a")
+    # The cached body of the old version was exported without checking the tree's versions
+    tree.crawled_at -= 3600
+    ops.export_html_folder(tree, str(tmp_path), Queue(), incremental=True)
+    html = exported_html(tmp_path)
+    assert "a v2" in html and "a v1" not in html
+    assert tree.versions[tree.index("a")] == 2
+
+
+def test_export_of_recent_tree_does_not_check_versions(tmp_path):
+    api = FakeApi({"0": None, "a": "0"})
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    api.requests.clear()
+    ops.export_html_folder(tree, str(tmp_path), Queue())
+    assert not [r for r in api.requests if r[0] == "rest/api/content/search"]
@@ -0,0 +1,89 @@
+import threading
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import gdrive_client
+from gdrive_client import GDriveClient
+from rate_limit import AdaptiveLimiter, is_google_throttled
+
+
+def http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": status, "retry-after": "0"}), b"{}")
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.service.batches.append([request for request, _ in self.requests])
+        for request, request_id in self.requests:
+            # Each request fails with the next of its errors, if any, and then succeeds
+            errors = self.service.errors.get(request, [])
+            if errors:
+                self.callback(request_id, None, errors.pop(0))
+            else:
+                self.callback(request_id, {"id": request}, None)
+
+
+class FakeService:
+    def __init__(self, errors: dict[str, list[Exception]]):
+        self.errors = errors
+        self.batches: list[list[str]] = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def make_client(errors: dict[str, list[Exception]], max_retries: int = 8) -> GDriveClient:
+    gclient = GDriveClient.__new__(GDriveClient)
+    gclient.local = threading.local()
+    gclient.local.service = FakeService(errors)
+    gclient.limiter = AdaptiveLimiter(
+        "GDrive",
+        rate=10_000,
+        max_concurrency=8,
+        is_throttled=is_google_throttled,
+        max_retries=max_retries,
+    )
+    return gclient
+
+
+def test_execute_batch_returns_errors_of_failed_requests():
+    not_found = http_error(404)
+    gclient = make_client({"b": [not_found]})
+    results = gclient.execute_batch(["a", "b", "c"])
+    assert results == [({"id": "a"}, None), (None, not_found), ({"id": "c"}, None)]
+    assert gclient.service.batches == [["a", "b", "c"]]
+
+
+def test_execute_batch_retries_only_throttled_requests():
+    gclient = make_client({"b": [http_error(429), http_error(403)], "c": [http_error(503)]})
+    # A 403 error is only retried if it is for a rate limit
+    results = gclient.execute_batch(["a", "b", "c", "d"])
+    assert [error.status_code if error else None for _, error in results] == [None, 403, None, None]
+    assert [response for response, _ in results] == [{"id": "a"}, None, {"id": "c"}, {"id": "d"}]
+    assert gclient.service.batches == [["a", "b", "c", "d"], ["b", "c"]]
+    assert gclient.limiter.stats()["throttled"] == 1
+
+
+def test_execute_batch_gives_up_on_requests_that_stay_throttled():
+    throttled = http_error(429)
+    gclient = make_client({"a": [throttled] * 3}, max_retries=2)
+    results = gclient.execute_batch(["a", "b"])
+    assert results == [(None, throttled), ({"id": "b"}, None)]
+    assert gclient.service.batches == [["a", "b"], ["a"], ["a"]]
+
+
+def test_execute_batch_splits_requests_into_batches(monkeypatch):
+    monkeypatch.setattr(gdrive_client, "MAX_BATCH_SIZE", 2)
+    gclient = make_client({"c": [http_error(429)]})
+    results = gclient.execute_batch(["a", "b", "c", "d", "e"])
+    assert [response["id"] for response, _ in results] == ["a", "b", "c", "d", "e"]
+    assert gclient.service.batches == [["a", "b"], ["c", "d"], ["c"], ["e"]]
@@ -0,0 +1,39 @@
+import io
+
+import pytest
+
+from html_serializer import write_prettified, write_streaming
+
+EDGE_CASES = [
+    "<p>a<![CDATA[x<y]]>b</p>",
+    "<svg><![CDATA[ .a { fill: red } ]]></svg>",
+    "<!--[if IE]><p>ie</p><![endif]-->",
+    "<![if !IE]><p>not ie</p><![endif]>",
+    "<p>&amp; &lt; &nbsp; &copy &unknown; &#169; &#xA9;</p>",
+    '<img src="a.png" alt="&quot;x&quot;"><br/><input disabled>',
+    "<div><p>unclosed<span>tags</div></p>",
+    "<script>if (a < b && c > d) {}</script><style>p > a {}</style>",
+    "<!DOCTYPE html><p>x</p>",
+]
+
+
+def serialize(write, html_value: str) -> str:
+    out = io.StringIO()
+    write(html_value, out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("html_value", EDGE_CASES)
+def test_streaming_matches_prettify(html_value):
+    # prettify() indents, so compare after passing the streamed output through it as well
+    streamed = serialize(write_streaming, html_value)
+    assert serialize(write_prettified, streamed) == serialize(write_prettified, html_value)
+
+
+def test_cdata_round_trip():
+    assert serialize(write_streaming, "<p><![CDATA[x]]></p>") == "<p><![CDATA[x]]></p>"
+
+
+def test_conditional_section_round_trip():
+    html_value = "<![if !IE]><p>x</p><![endif]>"
+    assert serialize(write_streaming, html_value) == html_value
@@ -0,0 +1,87 @@
+from datetime import datetime
+
+from page_tree import PageTree
+
+MODIFIED = datetime(2025, 1, 1)
+
+
+def make_tree(parents: dict[str, str | None], stub_ids=()) -> PageTree:
+    "parents maps each page id to its parent's id in pre-order; the root page's parent is None"
+    index = {page_id: i for i, page_id in enumerate(parents)}
+    pages = [
+        (page_id, index[parent_id] if parent_id else -1, f"Page {page_id}", MODIFIED, 1, "")
+        for page_id, parent_id in parents.items()
+    ]
+    return PageTree(pages, base_url="", space_name="S", ancestor_titles=[], stub_ids=stub_ids)
+
+
+def test_copy_does_not_share_stubs_or_stale_counts():
+    tree = make_tree({"0": None, "a": "0", "a1": "a"}, stub_ids=["a"])
+    tree.stale_counts["a"] = 3
+    tree_copy = tree.copy()
+    tree_copy.stale_counts["0"] = 5
+    tree_copy.update([("a2", ["0", "a"], "Page a2", MODIFIED, 1, "")], deleted_ids=["a1"])
+    assert tree.stale_counts == {"a": 3}
+    assert tree.stub_ids == {"a"}
+    assert tree.ids == ["0", "a", "a1"]
+
+
+def changed(page_id, ancestor_ids):
+    return page_id, ancestor_ids, f"Page {page_id}", MODIFIED, 2, ""
+
+
+def parent_ids(tree: PageTree) -> dict[str, str | None]:
+    "Checks that children() and subtree_ends agree with the parents, and returns the parent ids"
+    for i in range(len(tree)):
+        assert list(tree.children(i)) == [c for c in range(len(tree)) if tree.parents[c] == i]
+        descendants = [d for d in range(len(tree)) if i in tree.ancestors(d) and d != i]
+        assert tree.subtree_ends[i] == i + 1 + len(descendants)
+        assert descendants == list(range(i + 1, tree.subtree_ends[i]))
+        assert tree.index(tree.ids[i]) == i
+    return {
+        page_id: tree.ids[tree.parents[i]] if tree.parents[i] >= 0 else None
+        for i, page_id in enumerate(tree.ids)
+    }
+
+
+def test_update_moves_children_of_deleted_page_to_its_parent():
+    tree = make_tree({"0": None, "a": "0", "a1": "a", "a2": "a", "b": "0"})
+    tree.update([], deleted_ids=["a"])
+    assert parent_ids(tree) == {"0": None, "a1": "0", "a2": "0", "b": "0"}
+    assert tree.ids == ["0", "a1", "a2", "b"]
+
+
+def test_update_moves_page_with_its_subtree():
+    tree = make_tree({"0": None, "a": "0", "a1": "a", "b": "0", "b1": "b", "b11": "b1"})
+    tree.update([changed("b1", ["0", "a"])])
+    assert parent_ids(tree) == {"0": None, "a": "0", "a1": "a", "b1": "a", "b11": "b1", "b": "0"}
+    assert tree.ids == ["0", "a", "a1", "b1", "b11", "b"]
+    assert tree.versions[tree.index("b1")] == 2
+
+
+def test_update_adds_selected_new_page_and_keeps_selections():
+    tree = make_tree({"0": None, "a": "0", "b": "0"})
+    tree.set_include(tree.index("a"), False)
+    # The closest ancestor in the tree is the parent
+    tree.update([changed("b1", ["0", "b"]), changed("c", ["0", "unknown"])])
+    assert parent_ids(tree) == {"0": None, "a": "0", "b": "0", "b1": "b", "c": "0"}
+    assert [tree.include[tree.index(p)] for p in ["0", "a", "b", "b1", "c"]] == [1, 0, 1, 1, 1]
+    assert tree.include_count == 4
+
+
+def test_update_prunes_stubs_without_pages_under_them():
+    tree = make_tree(
+        {"0": None, "a": "0", "a1": "a", "b": "0", "b1": "b", "b11": "b1"}, stub_ids=["a", "b"]
+    )
+    tree.update([changed("c", ["0"])], deleted_ids=["a1"], stub_pages=[changed("b", ["0"])])
+    assert parent_ids(tree) == {"0": None, "b": "0", "b1": "b", "b11": "b1", "c": "0"}
+    assert tree.stub_ids == {"b"}
+
+
+def test_update_selects_stub_that_was_changed():
+    tree = make_tree({"0": None, "a": "0", "a1": "a"}, stub_ids=["a"])
+    tree.set_include(tree.index("a"), False)
+    tree.update([changed("a", ["0"])])
+    assert tree.stub_ids == set()
+    assert tree.include[tree.index("a")] == 1
+    assert parent_ids(tree) == {"0": None, "a": "0", "a1": "a"}
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from queue import Queue
+
+import main
+from fake_confluence import FakeApi, make_ops
+from rate_limit import AdaptiveLimiter
+
+
+def make_limiter(max_concurrency: int) -> AdaptiveLimiter:
+    return AdaptiveLimiter(
+        "test", rate=10_000, max_concurrency=max_concurrency, is_throttled=lambda e: None
+    )
+
+
+def test_acall_wakes_waiting_coroutines_when_slots_free_up():
+    limiter = make_limiter(2)
+    in_flight = []
+
+    async def work():
+        in_flight.append(1)
+        assert len(in_flight) <= 2
+        await asyncio.sleep(0.001)
+        in_flight.pop()
+
+    async def run():
+        await asyncio.gather(*(limiter.acall(work) for _ in range(40)))
+
+    started = time.monotonic()
+    asyncio.run(run())
+    # Polling every 50ms would take at least 20 * 0.05s
+    assert time.monotonic() - started < 0.5
+    assert limiter.in_flight == 0 and not limiter.async_waiters
+
+
+def test_acall_is_woken_by_call_in_another_thread():
+    limiter = make_limiter(1)
+    entered, release = threading.Event(), threading.Event()
+
+    def hold():
+        entered.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=limiter.call, args=(hold,))
+    thread.start()
+    entered.wait(5)
+
+    async def run():
+        waiting = asyncio.create_task(limiter.acall(asyncio.sleep, 0, result="done"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        release.set()
+        return await asyncio.wait_for(waiting, 5)
+
+    assert asyncio.run(run()) == "done"
+    thread.join(5)
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    limiter = make_limiter(1)
+
+    async def run():
+        holder = asyncio.create_task(limiter.acall(asyncio.sleep, 0.05))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(limiter.acall(asyncio.sleep, 0))
+        waiting = asyncio.create_task(limiter.acall(asyncio.sleep, 0, result="done"))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await holder
+        return await asyncio.wait_for(waiting, 5)
+
+    assert asyncio.run(run()) == "done"
+    assert limiter.in_flight == 0 and not limiter.async_waiters
+
+
+class FakeAsyncClient:
+    "Stands in for AsyncConfluenceClient, recording how many tasks exist at once"
+
+    def __init__(self, api: FakeApi):
+        self.api = api
+        self.max_tasks = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get_page_html(self, page_id: str, version: int | None = None) -> str:
+        self.max_tasks = max(self.max_tasks, len(asyncio.all_tasks()))
+        await asyncio.sleep(0.001)
+        return self.api.page(page_id, "body")["body"]["export_view"]["value"]
+
+
+def test_async_export_bounds_the_number_of_tasks(tmp_path, monkeypatch):
+    api = FakeApi({"0": None, **{str(n): "0" for n in range(1, 30)}})
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    ops.backend = "async"
+    aclient = FakeAsyncClient(api)
+    monkeypatch.setattr(ops, "_create_async_client", lambda: aclient)
+    monkeypatch.setattr(main, "ASYNC_MAX_CONNECTIONS", 4)
+    queue = Queue()
+    ops.export_html_folder(tree, str(tmp_path), queue)
+    # The export tasks and the main task
+    assert aclient.max_tasks <= 4 + 1
+    assert len(list(tmp_path.rglob("*.html"))) == 30
+    messages = [queue.get() for _ in range(queue.qsize())]
+    # Progress is still reported in tree order
+    saved = [m.split("`")[1] for m in messages if m.startswith("Saved page")]
+    assert saved == [tree.titles[i] for i in range(len(tree))]
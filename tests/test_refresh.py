@@ -0,0 +1,55 @@
+from fake_confluence import FakeApi, make_ops, tree_shape
+from response_cache import ResponseCache
+
+
+def make_api() -> FakeApi:
+    # "0" is the queried page; "x" is outside of its tree
+    return FakeApi(
+        {"0": None, "a": "0", "b": "0", "a1": "a", "a2": "a", "b1": "b", "x": None, "x1": "x"}
+    )
+
+
+def test_refresh_applies_edits_and_new_pages():
+    api = make_api()
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    api.edit("a1", title="Renamed")
+    api.add("b2", "b")
+    ops.refresh_tree(tree, "S")
+    assert tree_shape(tree) == tree_shape(ops.query_pages_as_tree("S", "Page 0"))
+
+
+def test_refresh_reconciles_deletion_and_move_with_same_page_count():
+    api = make_api()
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    # The number of pages under "0" stays the same and neither change modifies a page
+    api.delete("a2")
+    api.move("x1", "b")
+    ops.refresh_tree(tree, "S")
+    shape = tree_shape(tree)
+    assert "a2" not in shape
+    assert shape["x1"][0] == "b"
+    assert shape == tree_shape(ops.query_pages_as_tree("S", "Page 0"))
+
+
+def test_refresh_reparents_children_of_deleted_page():
+    api = make_api()
+    ops = make_ops(api)
+    tree = ops.query_pages_as_tree("S", "Page 0")
+    # Confluence moves the children of a deleted page to its parent
+    api.move("a1", "0")
+    api.move("a2", "0")
+    api.delete("a")
+    ops.refresh_tree(tree, "S")
+    assert tree_shape(tree) == tree_shape(ops.query_pages_as_tree("S", "Page 0"))
+
+
+def test_requery_by_child_listing_ignores_cached_listings(tmp_path):
+    api = make_api()
+    ops = make_ops(api, ResponseCache(str(tmp_path)))
+    ops.query_pages_as_tree("S", "Page 0", use_cql=False)
+    api.edit("a1", title="Renamed")
+    api.add("b2", "b")
+    tree = ops.query_pages_as_tree("S", "Page 0", use_cql=False)
+    assert tree_shape(tree) == tree_shape(make_ops(api).query_pages_as_tree("S", "Page 0"))
@@ -0,0 +1,49 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=250)
+    cache.set("a", "x" * 50)
+    cache.set("b", "x" * 50)
+    assert cache.get("a") == "x" * 50
+    cache.set("c", "x" * 50)
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("c") == "x" * 50
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / f) for f in os.listdir(tmp_path))
+    # The index is rebuilt from the files
+    assert ResponseCache(str(tmp_path)).entries == cache.entries
+
+
+def test_file_io_is_not_done_under_the_lock(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path))
+    load = json.load
+
+    def checked_load(f):
+        assert not cache.lock.locked()
+        return load(f)
+
+    monkeypatch.setattr(response_cache.json, "load", checked_load)
+    cache.set("a", [1, 2])
+    assert cache.get("a") == [1, 2]
+
+
+def test_concurrent_use_keeps_sizes_consistent(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=2000)
+
+    def use(n):
+        key = f"key {n % 20}"
+        cache.set(key, "x" * n)
+        value = cache.get(key)
+        assert value is None or value.startswith("x")
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(use, range(1, 200)))
+    files = [f for f in os.listdir(tmp_path) if f.endswith(".json")]
+    assert sorted(files) == sorted(cache.entries)
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / f) for f in files)
+    assert cache.total_bytes <= 2000
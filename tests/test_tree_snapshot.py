@@ -0,0 +1,41 @@
+import os
+import time
+from datetime import datetime
+
+from page_tree import PageTree
+from tree_snapshot import TreeSnapshots
+
+
+def make_tree(title: str) -> PageTree:
+    pages = [
+        ("0", -1, title, datetime(2025, 1, 1), 1, ""),
+        ("a", 0, "A", datetime(2025, 1, 2), 2, ""),
+    ]
+    return PageTree(pages, base_url="", space_name="S", ancestor_titles=[])
+
+
+def set_used_at(snapshots: TreeSnapshots, key: tuple, used_at: float):
+    os.utime(snapshots._path(key), (used_at, used_at))
+
+
+def test_least_recently_used_snapshots_are_deleted(tmp_path):
+    snapshots = TreeSnapshots(str(tmp_path), max_count=2)
+    now = time.time()
+    for n in range(2):
+        snapshots.save(("url", "user", n), make_tree(f"Root {n}"))
+        set_used_at(snapshots, ("url", "user", n), now - 100 + n)
+    assert snapshots.load(("url", "user", 0)).root_title == "Root 0"
+    snapshots.save(("url", "user", 2), make_tree("Root 2"))
+    assert snapshots.load(("url", "user", 1)) is None
+    assert snapshots.load(("url", "user", 0)).root_title == "Root 0"
+    assert snapshots.load(("url", "user", 2)).ids == ["0", "a"]
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_expired_snapshots_are_ignored_and_deleted(tmp_path):
+    snapshots = TreeSnapshots(str(tmp_path), max_days=1)
+    snapshots.save(("url", "user", 0), make_tree("Root"))
+    set_used_at(snapshots, ("url", "user", 0), time.time() - 2 * 24 * 3600)
+    assert snapshots.load(("url", "user", 0)) is None
+    TreeSnapshots(str(tmp_path), max_days=1)
+    assert os.listdir(tmp_path) == []